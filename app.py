@@ -1,92 +1,936 @@
-from elevenlabs import ElevenLabs, save   # ✅ simplified import
 from dotenv import load_dotenv
 import os
-import sqlite3
 import uuid
-import threading
+import functools
+import gzip
 import logging
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory, g
-import requests
+import json
+import mimetypes
+import re
+import math
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, g, has_request_context, jsonify, render_template,
+                   request, stream_with_context)
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+from werkzeug.local import LocalProxy
+from werkzeug.serving import is_running_from_reloader
+import archive
+import blobs
+import idempotency
+import search
+import storage
+from broker import EventRelay, MessageBroker
+from sweeper import OrphanSweeper
+from jobs import JobQueue, PermanentJobError, QueueFull, RetryLater
+from jsonprovider import provider_for
+from limits import Budget, Overloaded, RateLimiter
+from metrics import Registry
+from tts import TTSService
+from uploads import UploadRequest, UploadTooLarge, copy_stream, save_file_storage, upload_ext
+from webhook import CircuitOpen, WebhookClient
+
+try:
+    import fcntl
+except ImportError:  # Windows: resumable uploads are only locked per process
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
 
-# ✅ Initialize ElevenLabs client
-client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
-
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, "chat.db")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-app = Flask(__name__)
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-app.config["DATABASE"] = DB_PATH
+
+def _configure(app):
+    # Settings from the environment, with their defaults
+    app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+    app.config["DATABASE"] = DB_PATH
+    app.config["ELEVENLABS_API_KEY"] = os.getenv("ELEVENLABS_API_KEY")
+    # An object with the ElevenLabs client's text_to_speech.convert(); when
+    # unset the real client is created on first use
+    app.config["TTS_CLIENT"] = None
+    app.config["TTS_VOICE_ID"] = os.getenv("TTS_VOICE_ID", "EXAVITQu4vr4xnSDxMaL")
+    app.config["TTS_MODEL_ID"] = os.getenv("TTS_MODEL_ID", "eleven_multilingual_v2")
+    app.config["TTS_OUTPUT_FORMAT"] = os.getenv("TTS_OUTPUT_FORMAT", "mp3_44100_128")
+    app.config["TTS_CACHE_DIR"] = os.getenv("TTS_CACHE_DIR", os.path.join(BASE_DIR, "tts_cache"))
+    app.config["TTS_CACHE_MAX_BYTES"] = int(os.getenv("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    # Replies longer than this many characters are synthesized sentence by
+    # sentence (0 disables), with up to TTS_PARALLEL upstream calls at a time
+    app.config["TTS_SEGMENT_CHARS"] = int(os.getenv("TTS_SEGMENT_CHARS", 300))
+    app.config["TTS_PARALLEL"] = int(os.getenv("TTS_PARALLEL", 4))
+    app.config["JOB_WORKERS"] = int(os.getenv("JOB_WORKERS", 4))
+    app.config["JOB_QUEUE_MAX"] = int(os.getenv("JOB_QUEUE_MAX", 500))
+    app.config["JOB_MAX_ATTEMPTS"] = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+    app.config["JOB_LEASE"] = float(os.getenv("JOB_LEASE", 30))
+    app.config["IDEMPOTENCY_TTL"] = float(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+    app.config["IDEMPOTENCY_MAX_KEYS"] = int(os.getenv("IDEMPOTENCY_MAX_KEYS", 100000))
+    app.config["WEBHOOK_URL"] = os.getenv(
+        "WEBHOOK_URL", "https://idrak1ai.app.n8n.cloud/webhook/0292bfe4-98cd-4579-b5e3-219bb903e646",
+    )
+    app.config["WEBHOOK_POOL_SIZE"] = int(os.getenv("WEBHOOK_POOL_SIZE", 10))
+    app.config["WEBHOOK_CONNECT_TIMEOUT"] = float(os.getenv("WEBHOOK_CONNECT_TIMEOUT", 3.05))
+    app.config["WEBHOOK_READ_TIMEOUT"] = float(os.getenv("WEBHOOK_READ_TIMEOUT", 30))
+    app.config["WEBHOOK_RETRIES"] = int(os.getenv("WEBHOOK_RETRIES", 2))
+    app.config["WEBHOOK_BREAKER_THRESHOLD"] = int(os.getenv("WEBHOOK_BREAKER_THRESHOLD", 5))
+    app.config["WEBHOOK_BREAKER_RESET"] = float(os.getenv("WEBHOOK_BREAKER_RESET", 30))
+    app.config["UPLOADS_ACCEL_REDIRECT"] = os.getenv("UPLOADS_ACCEL_REDIRECT")
+    app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"
+    app.config["MAX_UPLOAD_BYTES"] = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+    # Bodies past this are refused with 413 before they are read; multipart
+    # framing gets a little headroom on top of the file itself.
+    app.config["MAX_CONTENT_LENGTH"] = app.config["MAX_UPLOAD_BYTES"] + 64 * 1024
+    app.config["UPLOAD_SESSION_TTL"] = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+    app.config["GC_INTERVAL"] = float(os.getenv("GC_INTERVAL", 3600))
+    app.config["GC_GRACE"] = float(os.getenv("GC_GRACE", 3600))
+    app.config["GC_MAX_OPS"] = int(os.getenv("GC_MAX_OPS", 200))
+    app.config["GROUP_COMMIT"] = os.getenv("GROUP_COMMIT", "0") == "1"
+    app.config["GROUP_COMMIT_MAX_BATCH"] = int(os.getenv("GROUP_COMMIT_MAX_BATCH", 256))
+    app.config["GROUP_COMMIT_MAX_DELAY_MS"] = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", 0))
+    app.config["SERVER_TIMING"] = os.getenv("SERVER_TIMING", "0") == "1"
+    # Messages older than ARCHIVE_AFTER_DAYS (0 keeps everything hot) move to
+    # ARCHIVE_DATABASE and their audio into bundles under ARCHIVE_DIR; both
+    # default to an archive/ directory next to DATABASE, so they always pair up
+    app.config["ARCHIVE_DIR"] = os.getenv("ARCHIVE_DIR")
+    app.config["ARCHIVE_DATABASE"] = os.getenv("ARCHIVE_DATABASE")
+    app.config["ARCHIVE_AFTER_DAYS"] = float(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+    app.config["ARCHIVE_INTERVAL"] = float(os.getenv("ARCHIVE_INTERVAL", 3600))
+    app.config["ARCHIVE_BATCH"] = int(os.getenv("ARCHIVE_BATCH", 500))
+    app.config["ARCHIVE_BUNDLE_MAX_BYTES"] = int(os.getenv("ARCHIVE_BUNDLE_MAX_BYTES", 1024 ** 3))
+    # Per-client rate limits, in requests per minute with a burst allowance (0
+    # turns a limit off). Clients are told apart by address, or by the last
+    # entry of RATE_LIMIT_CLIENT_HEADER (e.g. X-Forwarded-For) behind a proxy.
+    app.config["UPLOAD_RATE"] = float(os.getenv("UPLOAD_RATE", 60))
+    app.config["UPLOAD_BURST"] = int(os.getenv("UPLOAD_BURST", 20))
+    app.config["WEBHOOK_RECEIVE_RATE"] = float(os.getenv("WEBHOOK_RECEIVE_RATE", 600))
+    app.config["WEBHOOK_RECEIVE_BURST"] = int(os.getenv("WEBHOOK_RECEIVE_BURST", 100))
+    app.config["RATE_LIMIT_CLIENT_HEADER"] = os.getenv("RATE_LIMIT_CLIENT_HEADER")
+    # Most webhook and TTS calls in flight at once across all processes (0 is
+    # unlimited); a slot held by a crashed process frees itself after
+    # CONCURRENCY_SLOT_TTL seconds
+    app.config["WEBHOOK_MAX_CONCURRENCY"] = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", 16))
+    app.config["TTS_MAX_CONCURRENCY"] = int(os.getenv("TTS_MAX_CONCURRENCY", 8))
+    # Seconds a TTS call waits for a free slot before the reply goes text-only
+    app.config["TTS_SLOT_WAIT"] = float(os.getenv("TTS_SLOT_WAIT", 5))
+    app.config["CONCURRENCY_SLOT_TTL"] = float(os.getenv("CONCURRENCY_SLOT_TTL", 600))
+    # JSON encoder for responses and request bodies: auto (orjson if installed),
+    # orjson, stdlib (compact json module) or flask (Flask's own)
+    app.config["JSON_PROVIDER"] = os.getenv("JSON_PROVIDER", "auto")
+    # JSON responses at least this large are gzip/deflate-encoded for clients
+    # that accept it (0 turns compression off)
+    app.config["JSON_COMPRESS_MIN_BYTES"] = int(os.getenv("JSON_COMPRESS_MIN_BYTES", 1024))
+    # Largest NDJSON body POST /api/messages/import accepts (before decompression)
+    app.config["IMPORT_MAX_BYTES"] = int(os.getenv("IMPORT_MAX_BYTES", 10 * 1024 ** 3))
+    # Route stream events through the events table so listeners on any worker
+    # process see writes made by the others; on by default in wsgi.py
+    app.config["EVENT_LOG"] = os.getenv("EVENT_LOG", "0") == "1"
+    app.config["EVENT_POLL_INTERVAL"] = float(os.getenv("EVENT_POLL_INTERVAL", 0.1))
+    app.config["EVENT_RETENTION"] = float(os.getenv("EVENT_RETENTION", 300))
+
 
 logging.basicConfig(level=logging.INFO)
 
-WEBHOOK_URL = "https://idrak1ai.app.n8n.cloud/webhook/0292bfe4-98cd-4579-b5e3-219bb903e646"
+# Routes, hooks and CLI commands; create_app() registers them on each app
+bp = Blueprint("chat", __name__, cli_group=None)
+
+# Pagination defaults for GET /api/messages
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Seconds between keep-alive comments on idle /api/messages/stream connections
+SSE_HEARTBEAT = 15
+
+# Messages belong to a conversation; requests that don't name one use this
+DEFAULT_CONVERSATION = "default"
+CONVERSATION_ID_RE = re.compile(r"[A-Za-z0-9_.:-]{1,128}")
+
+# In-process metrics, served in Prometheus text format at /metrics
+metrics = Registry()
+stage_seconds = metrics.histogram(
+    "chat_stage_seconds", "Time spent in each stage of handling uploads, replies and writes.", ["stage"],
+)
+request_seconds = metrics.histogram(
+    "chat_http_request_seconds", "Time to produce a response, by endpoint.", ["method", "endpoint"],
+)
+responses_total = metrics.counter(
+    "chat_http_responses_total", "Responses sent, by endpoint and status.", ["method", "endpoint", "status"],
+)
+job_seconds = metrics.histogram("chat_job_seconds", "Background job run time, by kind.", ["kind"])
+job_runs_total = metrics.counter("chat_job_runs_total", "Background job runs, by kind and outcome.", ["kind", "outcome"])
+admissions_total = metrics.counter(
+    "chat_admissions_total", "Work admitted or shed by rate limits and concurrency budgets.", ["gate", "outcome"],
+)
+
+
+def _job_finished(kind, outcome, seconds):
+    job_seconds.observe(seconds, kind=kind)
+    job_runs_total.inc(kind=kind, outcome=outcome)
+
+
+@contextmanager
+def stage(name):
+    # Times a step into chat_stage_seconds and, when SERVER_TIMING is on and
+    # we're inside a request, into that response's Server-Timing header.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=name)
+        if has_request_context() and current_app.config["SERVER_TIMING"]:
+            g.setdefault("_timings", []).append((name, elapsed))
+
+
+class _Services:
+    """One app's background services and clients, in app.extensions["chat"].
+
+    Built from the app's config by _build_services() and started in each
+    serving process by start_background(app).
+    """
+
+    def __init__(self):
+        # Committed inserts/deletes are published here and fanned out to SSE
+        # listeners
+        self.broker = MessageBroker()
+        # Job queue (webhook forwarding, bot replies), orphan sweeper,
+        # archiver and, with EVENT_LOG, the event relay
+        self.jobs = self.sweeper = self.archiver = self.relay = None
+        # Optional single writer thread that batches writes into shared
+        # transactions (GROUP_COMMIT=1)
+        self.writer = None
+        # Per-client rate limiters ("uploads", "webhook_receive") and
+        # cross-process concurrency budgets for upstream calls ("webhook",
+        # "tts")
+        self.limiters = {}
+        self.budgets = {}
+        # The TTS and webhook clients, built from the config on first use, so
+        # creating the app or running CLI commands doesn't need ElevenLabs or
+        # open connections
+        self.clients = {}
+
+
+def _services():
+    return current_app.extensions["chat"]
+
+
+# The current app's services, for code running in its context: requests,
+# CLI commands and job handlers
+broker = LocalProxy(_services, "broker")
+jobs = LocalProxy(_services, "jobs")
+sweeper = LocalProxy(_services, "sweeper")
+archiver = LocalProxy(_services, "archiver")
+limiters = LocalProxy(_services, "limiters")
+budgets = LocalProxy(_services, "budgets")
+
+# Seconds a client is told to wait when the job queue is full
+QUEUE_FULL_RETRY_AFTER = 30
+
+
+def _client_key():
+    header = current_app.config["RATE_LIMIT_CLIENT_HEADER"]
+    if header and request.headers.get(header):
+        # The proxy appends the address it saw; earlier entries are whatever
+        # the client sent.
+        return request.headers[header].split(",")[-1].strip()
+    return request.remote_addr
+
+
+def rate_limited(name):
+    # Sheds requests over the client's rate with 429 before any work is done.
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = limiters[name].acquire(_client_key())
+            if retry_after:
+                resp = jsonify({"error": "too many requests, slow down"})
+                resp.status_code = 429
+                resp.headers["Retry-After"] = str(math.ceil(retry_after))
+                return resp
+            return view(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+_clients_lock = threading.Lock()
+
+
+def _client(name, build):
+    clients = _services().clients
+    client = clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = clients.get(name)
+            if client is None:
+                client = clients[name] = build()
+    return client
+
+
+def _build_tts():
+    client = current_app.config["TTS_CLIENT"]
+    if client is None:
+        from elevenlabs import ElevenLabs
+        client = ElevenLabs(api_key=current_app.config["ELEVENLABS_API_KEY"])
+    return TTSService(
+        client,
+        cache_dir=current_app.config["TTS_CACHE_DIR"],
+        max_cache_bytes=current_app.config["TTS_CACHE_MAX_BYTES"],
+        voice_id=current_app.config["TTS_VOICE_ID"],
+        model_id=current_app.config["TTS_MODEL_ID"],
+        output_format=current_app.config["TTS_OUTPUT_FORMAT"],
+        segment_chars=current_app.config["TTS_SEGMENT_CHARS"],
+        max_parallel=current_app.config["TTS_PARALLEL"],
+        budget=budgets["tts"],
+        slot_wait=current_app.config["TTS_SLOT_WAIT"],
+    )
+
+
+def get_tts():
+    # Single entry point for speech synthesis; repeated replies come from cache
+    return _client("tts", _build_tts)
+
+
+def get_webhook():
+    # Keep-alive client for the n8n webhook; fails fast while it is down
+    return _client("webhook", lambda: WebhookClient(
+        current_app.config["WEBHOOK_URL"],
+        pool_size=current_app.config["WEBHOOK_POOL_SIZE"],
+        connect_timeout=current_app.config["WEBHOOK_CONNECT_TIMEOUT"],
+        read_timeout=current_app.config["WEBHOOK_READ_TIMEOUT"],
+        retries=current_app.config["WEBHOOK_RETRIES"],
+        failure_threshold=current_app.config["WEBHOOK_BREAKER_THRESHOLD"],
+        reset_timeout=current_app.config["WEBHOOK_BREAKER_RESET"],
+    ))
+
+# Seconds between walks of the upload folder for the chat_upload_folder_bytes
+# gauge; it's the one gauge that isn't cheap to read
+UPLOAD_BYTES_TTL = 60
+_upload_bytes = {}
+
+
+def _upload_folder_bytes():
+    folder = current_app.config["UPLOAD_FOLDER"]
+    now = time.monotonic()
+    total, at = _upload_bytes.get(folder, (None, 0.0))
+    if total is None or now - at > UPLOAD_BYTES_TTL:
+        total = 0
+        for top, _, files in os.walk(folder):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(top, name))
+                except FileNotFoundError:
+                    pass
+        _upload_bytes[folder] = (total, now)
+    return total
+
+
+def _job_counts():
+    counts = jobs.stats(storage.pool.get(current_app.config["DATABASE"]))
+    return {(status,): counts[status] for status in ("pending", "running", "dead")}
+
+
+def _client_gauge(name, read):
+    # Clients that haven't been used yet report nothing.
+    return lambda: read(_services().clients[name]) if name in _services().clients else None
+
+
+metrics.gauge("chat_jobs", "Jobs in the queue, by status.", _job_counts, ["status"])
+metrics.gauge("chat_job_workers_busy", "Job workers currently running a job.", lambda: jobs.busy)
+metrics.gauge("chat_stream_listeners", "Open /api/messages/stream connections.", lambda: broker.listeners)
+metrics.gauge("chat_upload_folder_bytes", "Bytes stored under the upload folder.", _upload_folder_bytes)
+metrics.gauge("chat_tts_cache_bytes", "Bytes in the text-to-speech cache.",
+              _client_gauge("tts", lambda tts: tts.cache.size))
+metrics.gauge("chat_budget_in_use", "Concurrency budget slots held, by budget.",
+              lambda: {(name,): budget.in_use() for name, budget in budgets.items() if budget.limit}, ["budget"])
+metrics.gauge("chat_webhook_circuit_open", "1 while the webhook circuit breaker is open or half-open.",
+              _client_gauge("webhook", lambda webhook: int(webhook.breaker.state != "closed")))
 
 
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = sqlite3.connect(app.config["DATABASE"]) 
-        db.row_factory = sqlite3.Row
+        db = g._database = storage.pool.get(current_app.config["DATABASE"])
     return db
 
 
+def _archive_dir(config):
+    return config["ARCHIVE_DIR"] or os.path.join(os.path.dirname(config["DATABASE"]), "archive")
+
+
+def _attach_archive(config, conn):
+    archive.attach(conn, config["ARCHIVE_DATABASE"] or os.path.join(_archive_dir(config), "archive.db"))
+
+
 def init_db():
-    with app.app_context():
-        db = get_db()
-        db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                role TEXT NOT NULL,
-                text TEXT,
-                audio_filename TEXT,
-                created_at TEXT NOT NULL
-            )
-            """
+    # Safe to run from several processes at once: migrate() re-checks the
+    # schema version under the write lock.
+    config = current_app.config
+    os.makedirs(config["UPLOAD_FOLDER"], exist_ok=True)
+    storage.pool.on_connect[config["DATABASE"]] = functools.partial(_attach_archive, config)
+    storage.migrate(storage.pool.get(config["DATABASE"]))
+
+
+# Events recorded by the write running on this thread, for this process's
+# listeners once it commits; and the lock that keeps commits and their
+# publishing in the same order
+_pending = threading.local()
+_commit_lock = threading.Lock()
+
+
+def record_events(conn, events):
+    # Called inside a write with the (kind, data, topic) events for its
+    # changes. With EVENT_LOG they go into the events table in the same
+    # transaction and every process's relay delivers them; without it,
+    # write() publishes them right after the commit. Either way listeners
+    # get them in commit order, which for inserts is id order: streams skip
+    # ids at or below the last one sent.
+    if _services().relay is not None:
+        if events:
+            EventRelay.append(conn, events)
+    else:
+        _pending.events.extend(events)
+
+
+def _with_events(fn, conn):
+    # Runs fn(conn) and returns (its result, the events it recorded).
+    _pending.events = []
+    try:
+        return fn(conn), _pending.events
+    finally:
+        _pending.events = None
+
+
+def _publish(broker, events):
+    for kind, data, topic in events:
+        broker.publish(kind, data, topic)
+
+
+def _publish_batch(broker, results):
+    # GroupCommitWriter's on_commit: results are (result, events) pairs.
+    for _, events in results:
+        _publish(broker, events)
+
+
+def write(fn):
+    # Runs fn(conn) in a write transaction, commits, publishes the events fn
+    # recorded and returns its result. With GROUP_COMMIT enabled the work is
+    # batched with other writers' into a single commit on the writer thread,
+    # which publishes each batch's events after its commit.
+    writer = _services().writer
+    if writer is not None:
+        app = current_app._get_current_object()
+
+        def item(conn):
+            # Runs on the writer thread, which has no app context of its own.
+            with app.app_context():
+                return _with_events(fn, conn)
+
+        with stage("db_write"):
+            return writer.run(item)[0]
+    conn = storage.pool.get(current_app.config["DATABASE"])
+    with stage("db_write"):
+        try:
+            result, events = _with_events(fn, conn)
+            # Another thread's commit can't slip in between this one and its
+            # events reaching the listeners.
+            with _commit_lock:
+                with stage("db_commit"):
+                    conn.commit()
+                _publish(broker, events)
+        except Exception:
+            conn.rollback()
+            raise
+    return result
+
+
+def conversation_id_from(value):
+    # Conversation ids come from browsers and from n8n; keep them plain.
+    if value is None or value == "":
+        return DEFAULT_CONVERSATION
+    if not isinstance(value, str) or not CONVERSATION_ID_RE.fullmatch(value):
+        raise ValueError("conversation_id must be 1-128 letters, digits or '_.:-'")
+    return value
+
+
+def insert_message(role, text, audio_filename, tts_status=None, extra=None, conversation_id=DEFAULT_CONVERSATION,
+                   idempotency_key=None, fingerprint=None):
+    # Stores a message, publishes it to its conversation's stream listeners
+    # and returns it. extra(conn, msg_id) runs in the same transaction, e.g.
+    # to enqueue work. With an idempotency_key, a repeat of an earlier insert
+    # raises idempotency.Replayed with the message stored the first time.
+    now = datetime.utcnow().isoformat()
+    msg = {
+        "id": None, "conversation_id": conversation_id, "role": role, "text": text,
+        "audio_filename": audio_filename, "audio_segments": None, "tts_status": tts_status, "created_at": now,
+    }
+
+    def do_insert(conn):
+        if idempotency_key is not None:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            idempotency.check(conn, idempotency_key, current_app.config["IDEMPOTENCY_TTL"], fingerprint)
+        cur = conn.execute(
+            "INSERT INTO messages (conversation_id, role, text, audio_filename, tts_status, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (conversation_id, role, text, audio_filename, tts_status, now),
         )
-        db.commit()
+        if extra is not None:
+            extra(conn, cur.lastrowid)
+        msg["id"] = cur.lastrowid
+        if idempotency_key is not None:
+            idempotency.remember(
+                conn, idempotency_key, msg,
+                current_app.config["IDEMPOTENCY_TTL"], current_app.config["IDEMPOTENCY_MAX_KEYS"], fingerprint,
+            )
+        record_events(conn, [("insert", msg, conversation_id)])
+
+    write(do_insert)
+    return msg
+
+
+def insert_reply(role, text, audio_filename, conversation_id=DEFAULT_CONVERSATION, idempotency_key=None,
+                 fingerprint=None):
+    # Replies with text but no audio are stored right away and get their
+    # speech from a background job, which fills in audio_filename later.
+    # A replayed idempotency_key raises before anything is stored or queued.
+    keys = {"idempotency_key": idempotency_key, "fingerprint": fingerprint}
+    if not text or audio_filename:
+        return insert_message(role, text, audio_filename, conversation_id=conversation_id, **keys)
+    try:
+        msg = insert_message(role, text, None, tts_status="pending", extra=lambda conn, msg_id: jobs.enqueue(
+            "synthesize_speech", {"message_id": msg_id}, conn,
+        ), conversation_id=conversation_id, **keys)
+    except QueueFull:
+        logging.warning("Job queue full, storing reply without speech")
+        return insert_message(role, text, None, tts_status="failed", conversation_id=conversation_id, **keys)
+    jobs.wake()
+    return msg
+
+
+def _announce(conn, msg_id):
+    # Records an "update" event with the message as changed so far in this
+    # write.
+    row = conn.execute(f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    if row is not None:
+        record_events(conn, [("update", _message_dict(row), row["conversation_id"])])
+
+
+def synthesize_speech(job):
+    # Job handler: synthesizes a stored message's text and backfills its
+    # audio_filename/tts_status, then announces the change to listeners.
+    # Long replies are synthesized in sentence-sized pieces; each one is
+    # published in audio_segments (tts_status "partial") as soon as it and
+    # the ones before it are ready, so playback can start after the first.
+    msg_id = job.payload["message_id"]
+    db = storage.pool.get(current_app.config["DATABASE"])
+    row = db.execute("SELECT text FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    if row is None:
+        return
+
+    folder = current_app.config["UPLOAD_FOLDER"]
+    segments = []
+
+    def on_segment(index, path):
+        name = blobs.content_name(blobs.file_digest(path), os.path.splitext(path)[1])
+        segments.append(name)
+
+        def store(conn):
+            with stage("tts_store"):
+                blobs.adopt(path, folder, name)
+                # The link keeps the cache entry's older mtime; the sweeper's
+                # grace period for the piece starts now.
+                os.utime(blobs.locate(folder, name))
+            updated = conn.execute(
+                "UPDATE messages SET audio_segments = ?, tts_status = 'partial'"
+                " WHERE id = ? AND tts_status IN ('pending', 'partial')",
+                (json.dumps(segments), msg_id),
+            ).rowcount
+            if updated:
+                _announce(conn, msg_id)
+
+        write(store)
+
+    synthesized = None
+    try:
+        with stage("tts_synthesize"):
+            synthesized = os.path.join(folder, get_tts().synthesize_to(row["text"], folder, on_segment))
+        audio_filename = blobs.content_name(blobs.file_digest(synthesized), os.path.splitext(synthesized)[1])
+        status = "ready"
+    except Overloaded:
+        # Too many upstream TTS calls in flight: the reply stays text-only.
+        logging.warning(f"TTS concurrency budget exhausted, message {msg_id} stays text-only")
+        audio_filename, status = None, "skipped"
+    except Exception as e:
+        if synthesized:
+            os.remove(synthesized)
+        if job.attempts < jobs.max_attempts:
+            raise
+        logging.error(f"Failed ElevenLabs TTS for message {msg_id}: {e}")
+        synthesized, audio_filename, status = None, None, "failed"
+
+    def backfill(conn):
+        # Segment files are left for the orphan sweeper, so clients still
+        # playing them aren't cut off.
+        updated = conn.execute(
+            "UPDATE messages SET audio_filename = ?, audio_segments = NULL, tts_status = ? WHERE id = ?",
+            (audio_filename, status, msg_id),
+        ).rowcount
+        if not updated:
+            # Deleted while we were synthesizing.
+            return
+        if synthesized:
+            with stage("tts_store"):
+                blobs.adopt(synthesized, folder, audio_filename)
+        _announce(conn, msg_id)
+
+    try:
+        write(backfill)
+    finally:
+        if synthesized:
+            os.remove(synthesized)
+
+
+@bp.before_app_request
+def start_timer():
+    g._request_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request(resp):
+    started = g.pop("_request_started", None)
+    if started is None:
+        return resp
+    elapsed = time.perf_counter() - started
+    # Metric labels leave out the blueprint name.
+    endpoint = request.endpoint.rpartition(".")[2] if request.endpoint else "unmatched"
+    request_seconds.observe(elapsed, method=request.method, endpoint=endpoint)
+    responses_total.inc(method=request.method, endpoint=endpoint, status=resp.status_code)
+    if current_app.config["SERVER_TIMING"]:
+        timings = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in g.get("_timings", ())]
+        timings.append(f"total;dur={elapsed * 1000:.2f}")
+        resp.headers["Server-Timing"] = ", ".join(timings)
+    return resp
+
+
+# zlib level for compressed JSON responses. On message pages level 4 gets
+# within about 15% of level 9's size in a seventh of its time (see
+# benchmarks/json_response.py)
+COMPRESS_LEVEL = 4
+
+
+@bp.after_app_request
+def compress_response(resp):
+    # Registered after record_request, so it runs first and its time shows
+    # up in the request's metrics. Streams, files and small bodies are left
+    # alone.
+    min_bytes = current_app.config["JSON_COMPRESS_MIN_BYTES"]
+    if (not min_bytes or resp.mimetype != "application/json" or resp.is_streamed or resp.direct_passthrough
+            or resp.status_code in (204, 206, 304) or "Content-Encoding" in resp.headers):
+        return resp
+    data = resp.get_data()
+    if len(data) < min_bytes:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(("gzip", "deflate"))
+    if encoding is None:
+        return resp
+    with stage("compress"):
+        if encoding == "gzip":
+            data = gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+        else:
+            data = zlib.compress(data, COMPRESS_LEVEL)
+    resp.set_data(data)
+    resp.content_encoding = encoding
+    # The encoded bytes differ from the identity ones, so a strong validator
+    # no longer holds; If-None-Match still matches weakly.
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
 
 
-@app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+    # Connections stay open in the per-thread pool; just make sure no
+    # transaction outlives the request.
+    if getattr(g, "_database", None) is not None:
+        storage.pool.release()
 
 
-@app.route("/")
+@bp.route("/")
 def index():
     return render_template("index.html")
 
 
-@app.route("/uploads/<path:filename>")
-def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+# Upload names are random and never reused, so a file's bytes never change
+# and browsers may keep them for as long as they like.
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
+AUDIO_MIMETYPES = {".webm": "audio/webm", ".ogg": "audio/ogg", ".mp3": "audio/mpeg", ".mp4": "audio/mp4",
+                   ".m4a": "audio/mp4", ".wav": "audio/wav"}
 
+FILE_CHUNK_SIZE = 64 * 1024
 
-@app.route("/api/messages", methods=["GET", "POST"])
+
+def _iter_file_range(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+@bp.route("/uploads/<path:filename>")
+def uploaded_file(filename):
+    # URLs use the bare stored name; the file itself may sit in a shard, or
+    # in an archive bundle once its messages were archived.
+    path = blobs.locate(current_app.config["UPLOAD_FOLDER"], filename)
+    archived = None
+    if path is None:
+        archived = archive.find_blob(get_db(), filename)
+        if archived is None:
+            abort(404)
+        size = archived["size"]
+        mtime = datetime.fromtimestamp(archived["archived_at"], timezone.utc)
+    else:
+        st = os.stat(path)
+        size = st.st_size
+        mtime = datetime.fromtimestamp(st.st_mtime, timezone.utc)
+    ext = os.path.splitext(filename)[1].lower()
+    mimetype = AUDIO_MIMETYPES.get(ext) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    resp = Response(mimetype=mimetype, direct_passthrough=True)
+    resp.set_etag(f"{os.path.splitext(os.path.basename(filename))[0]}-{size}")
+    resp.last_modified = mtime
+    resp.cache_control.public = True
+    resp.cache_control.max_age = UPLOAD_MAX_AGE
+    resp.cache_control.immutable = True
+    resp.accept_ranges = "bytes"
+
+    # Let a front proxy serve the bytes (and ranges) itself when configured.
+    if archived is not None:
+        pass
+    elif current_app.config["UPLOADS_ACCEL_REDIRECT"]:
+        relpath = os.path.relpath(path, current_app.config["UPLOAD_FOLDER"]).replace(os.sep, "/")
+        resp.headers["X-Accel-Redirect"] = current_app.config["UPLOADS_ACCEL_REDIRECT"].rstrip("/") + "/" + relpath
+        return resp
+    elif current_app.config["USE_X_SENDFILE"]:
+        resp.headers["X-Sendfile"] = path
+        return resp
+
+    etag = resp.get_etag()[0]
+    if not is_resource_modified(request.environ, etag=etag, last_modified=mtime):
+        resp.status_code = 304
+        return resp
+
+    start, stop = 0, size
+    byte_range = request.range
+    if byte_range is not None and request.if_range.etag not in (None, etag):
+        byte_range = None  # If-Range validator doesn't match: send it all
+    if byte_range is not None:
+        bounds = byte_range.range_for_length(size)
+        if bounds is not None:
+            start, stop = bounds
+            resp.status_code = 206
+            resp.content_range = ContentRange("bytes", start, stop, size)
+        elif len(byte_range.ranges) == 1 or not size or all(first >= size for first, _ in byte_range.ranges):
+            resp.status_code = 416
+            resp.headers["Content-Range"] = f"bytes */{size}"
+            return resp
+        # Otherwise it asked for several ranges, some of them in the file.
+        # There's no multipart/byteranges here, and RFC 9110 lets a server
+        # ignore a Range it won't serve, so the whole file goes out.
+
+    if archived is not None:
+        f, base = archive.open_blob(_archive_dir(current_app.config), archived)
+    else:
+        f, base = open(path, "rb"), 0
+    f.seek(base + start)
+    resp.content_length = stop - start
+    # Servers that offer wsgi.file_wrapper (gunicorn, uWSGI, waitress...)
+    # send from the current offset up to Content-Length, using sendfile()
+    # where the platform has it; otherwise stream in chunks.
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        resp.response = file_wrapper(f, FILE_CHUNK_SIZE)
+    else:
+        resp.response = _iter_file_range(f, stop - start)
+    return resp
+
+
+def _conversation_stats(db, conversation_id):
+    row = db.execute(
+        "SELECT row_count, max_id, version, changed_at FROM conversation_stats WHERE conversation_id = ?",
+        (conversation_id,),
+    ).fetchone()
+    if row is None:
+        return {"row_count": 0, "max_id": 0, "version": 0, "changed_at": "1970-01-01T00:00:00"}
+    return row
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    value = int(value)
+    if value < 0:
+        raise ValueError(f"{name} must be non-negative")
+    return value
+
+
+MESSAGE_FIELDS = ("id", "conversation_id", "role", "text", "audio_filename", "audio_segments", "tts_status", "created_at")
+MESSAGE_COLUMNS = ", ".join(MESSAGE_FIELDS)
+
+
+def _fields_arg():
+    # ?fields=text,role: the message fields to return, in the usual order
+    # and always with id (cursors need it). None means all of them.
+    value = request.args.get("fields")
+    if not value:
+        return None
+    names = {name.strip() for name in value.split(",")} - {""}
+    unknown = names - set(MESSAGE_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown field(s) {', '.join(sorted(unknown))}; fields are {', '.join(MESSAGE_FIELDS)}")
+    return tuple(name for name in MESSAGE_FIELDS if name == "id" or name in names)
+
+
+def _message_dicts(db, sql, params, fields):
+    # Runs a query selecting `fields` (plus any trailing extra columns) and
+    # builds the message objects straight from plain tuple rows, which is
+    # much cheaper than going through sqlite3.Row. Returns (messages, rows).
+    cursor = db.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(sql, params).fetchall()
+    msgs = [dict(zip(fields, row)) for row in rows]
+    if "audio_segments" in fields:
+        for msg in msgs:
+            if msg["audio_segments"]:
+                msg["audio_segments"] = json.loads(msg["audio_segments"])
+    return msgs, rows
+
+
+def _message_dict(r):
+    return {
+        "id": r["id"],
+        "conversation_id": r["conversation_id"],
+        "role": r["role"],
+        "text": r["text"],
+        "audio_filename": r["audio_filename"],
+        "audio_segments": json.loads(r["audio_segments"]) if r["audio_segments"] else None,
+        "tts_status": r["tts_status"],
+        "created_at": r["created_at"],
+    }
+
+
+def _changed_messages(db, conversation_id, since_rev, limit=None, fields=MESSAGE_FIELDS):
+    # Rows of one conversation inserted or updated after change counter
+    # since_rev, oldest change first. Returns (messages, rev of the last
+    # returned change).
+    limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    msgs, rows = _message_dicts(
+        db,
+        f"SELECT {', '.join(fields)}, rev FROM messages WHERE conversation_id = ? AND rev > ? ORDER BY rev LIMIT ?",
+        (conversation_id, since_rev, limit),
+        fields,
+    )
+    return msgs, (rows[-1][-1] if rows else since_rev)
+
+
+def _page_messages(db, conversation_id, since_id=None, before_id=None, limit=None, fields=MESSAGE_FIELDS):
+    # since_id walks forward from a cursor (oldest first), before_id walks back
+    # from one, and a bare limit returns the newest rows. Pages are always
+    # returned in ascending id order so they can be appended/prepended as-is.
+    # Every query stays inside one conversation's (conversation_id, id) range.
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    elif since_id is not None or before_id is not None:
+        limit = DEFAULT_PAGE_SIZE
+
+    where, params = ["conversation_id = ?"], [conversation_id]
+    if since_id is not None:
+        where.append("id > ?")
+        params.append(since_id)
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    columns = ", ".join(fields)
+    sql = f"SELECT {columns} FROM messages WHERE " + " AND ".join(where)
+    if archive.archived_count(db, conversation_id):
+        # Older messages were archived; page through both tables. SQLite
+        # merges the two index walks, so this stays one ordered scan.
+        sql += f" UNION ALL SELECT {columns} FROM archive.messages WHERE " + " AND ".join(where)
+        params = params + params
+
+    newest_first = since_id is None and limit is not None
+    sql += " ORDER BY id DESC" if newest_first else " ORDER BY id ASC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    msgs, _ = _message_dicts(db, sql, params, fields)
+    if newest_first:
+        msgs.reverse()
+    return msgs
+
+
+@bp.route("/api/messages", methods=["GET", "POST"])
 def messages():
     db = get_db()
     if request.method == "GET":
-        cur = db.execute("SELECT * FROM messages ORDER BY id ASC")
-        rows = cur.fetchall()
-        msgs = []
-        for r in rows:
-            msgs.append({
-                "id": r["id"],
-                "role": r["role"],
-                "text": r["text"],
-                "audio_filename": r["audio_filename"],
-                "created_at": r["created_at"],
-            })
-        return jsonify(msgs)
+        try:
+            conversation_id = conversation_id_from(request.args.get("conversation_id"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            since_id = _int_arg("since_id")
+            before_id = _int_arg("before_id")
+            since_rev = _int_arg("since_rev")
+            limit = _int_arg("limit")
+        except ValueError:
+            return jsonify({"error": "since_id, before_id, since_rev and limit must be non-negative integers"}), 400
+        if since_rev is not None and (since_id is not None or before_id is not None):
+            return jsonify({"error": "since_rev cannot be combined with since_id or before_id"}), 400
+        try:
+            fields = _fields_arg()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        stats = _conversation_stats(db, conversation_id)
+        etag = f"{stats['row_count']}-{stats['max_id']}-{stats['version']}"
+        if fields is not None:
+            # A projection is a different representation of the same state.
+            etag += "-" + ".".join(fields)
+        last_modified = datetime.fromisoformat(stats["changed_at"]).replace(tzinfo=timezone.utc)
+        last_rev = stats["version"]
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            resp = Response(status=304)
+        elif since_rev is not None:
+            with stage("db_read"):
+                msgs, last_rev = _changed_messages(db, conversation_id, since_rev, limit, fields or MESSAGE_FIELDS)
+            resp = jsonify(msgs)
+        else:
+            with stage("db_read"):
+                msgs = _page_messages(db, conversation_id, since_id, before_id, limit, fields or MESSAGE_FIELDS)
+            resp = jsonify(msgs)
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        resp.cache_control.no_cache = True
+        resp.headers["X-Total-Count"] = str(stats["row_count"] + archive.archived_count(db, conversation_id))
+        resp.headers["X-Max-Id"] = str(stats["max_id"])
+        resp.headers["X-Last-Rev"] = str(last_rev)
+        return resp
 
     data = request.get_json(force=True)
     role = data.get("role")
@@ -94,185 +938,1165 @@ def messages():
     audio_filename = data.get("audio_filename")
     if role not in ("user", "bot"):
         return jsonify({"error": "role must be 'user' or 'bot'"}), 400
+    try:
+        conversation_id = conversation_id_from(data.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(insert_message(role, text, audio_filename, conversation_id=conversation_id))
+
+
+# Most messages a batch insert or an id-list delete takes, and most rows a
+# range delete removes per request (it reports `more` when it stopped short)
+MAX_BATCH_SIZE = 1000
+
+
+@bp.route("/api/messages/batch", methods=["POST"])
+def messages_batch():
+    # Inserts every valid item in one transaction (one executemany) and
+    # reports a result per item; invalid items are skipped, not fatal.
+    data = request.get_json(force=True)
+    items = data.get("messages") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "messages must be a non-empty list"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"at most {MAX_BATCH_SIZE} messages per batch"}), 400
+    try:
+        default_conversation = conversation_id_from(data.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     now = datetime.utcnow().isoformat()
-    cur = db.execute(
-        "INSERT INTO messages (role, text, audio_filename, created_at) VALUES (?, ?, ?, ?)",
-        (role, text, audio_filename, now),
+    results, rows = [], []
+    for item in items:
+        if not isinstance(item, dict) or item.get("role") not in ("user", "bot"):
+            results.append({"ok": False, "error": "role must be 'user' or 'bot'"})
+            continue
+        try:
+            conversation_id = conversation_id_from(item.get("conversation_id")) if "conversation_id" in item \
+                else default_conversation
+        except ValueError as e:
+            results.append({"ok": False, "error": str(e)})
+            continue
+        msg = {
+            "id": None, "conversation_id": conversation_id, "role": item["role"], "text": item.get("text"),
+            "audio_filename": item.get("audio_filename"), "audio_segments": None, "tts_status": None,
+            "created_at": now,
+        }
+        results.append({"ok": True, "message": msg})
+        rows.append(msg)
+
+    def do_insert(conn):
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO messages (conversation_id, role, text, audio_filename, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(m["conversation_id"], m["role"], m["text"], m["audio_filename"], now) for m in rows],
+        )
+        # We hold the write lock, so the AUTOINCREMENT ids are consecutive.
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        for msg_id, msg in enumerate(rows, last_id - len(rows) + 1):
+            msg["id"] = msg_id
+        record_events(conn, [("insert", msg, msg["conversation_id"]) for msg in rows])
+
+    if rows:
+        write(do_insert)
+    return jsonify({"inserted": len(rows), "failed": len(items) - len(rows), "results": results})
+
+
+# Rows per read while exporting and per transaction while importing, and
+# the longest NDJSON line an import accepts
+EXPORT_BATCH = 1000
+IMPORT_BATCH = 5000
+IMPORT_MAX_LINE = 1024 * 1024
+# Invalid import lines reported individually; the rest are only counted
+MAX_IMPORT_ERRORS = 100
+
+
+@bp.route("/api/messages/export")
+def export_messages():
+    # Streams matching messages, archived ones included, as NDJSON oldest
+    # first. Rows are read in id-keyed batches, each a short read of its
+    # own, so memory stays flat and writers aren't held up however long the
+    # download takes; after_id resumes an interrupted export. Compressed on
+    # the fly for clients that accept gzip.
+    where, params = ["id > ?"], []
+    try:
+        if request.args.get("conversation_id") is not None:
+            where.append("conversation_id = ?")
+            params.append(conversation_id_from(request.args["conversation_id"]))
+        role = request.args.get("role")
+        if role is not None:
+            if role not in ("user", "bot"):
+                raise ValueError("role must be 'user' or 'bot'")
+            where.append("role = ?")
+            params.append(role)
+        for name, clause in (("since", "created_at >= ?"), ("until", "created_at < ?")):
+            value = _timestamp_arg(request.args, name)
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        after_id = _int_arg("after_id") or 0
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    db = get_db()
+    sql = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE " + " AND ".join(where)
+    if db.execute("SELECT EXISTS (SELECT 1 FROM archive.messages)").fetchone()[0]:
+        sql += f" UNION ALL SELECT {MESSAGE_COLUMNS} FROM archive.messages WHERE " + " AND ".join(where)
+        tables = 2
+    else:
+        tables = 1
+    sql += " ORDER BY id LIMIT ?"
+    compress = request.accept_encodings["gzip"] > 0
+
+    def generate():
+        last_id = after_id
+        deflate = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        while True:
+            rows = db.execute(sql, [last_id, *params] * tables + [EXPORT_BATCH]).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            chunk = "".join(
+                current_app.json.dumps(_message_dict(row)) + "\n" for row in rows
+            ).encode("utf-8")
+            chunk = deflate.compress(chunk) if deflate else chunk
+            if chunk:
+                yield chunk
+            if len(rows) < EXPORT_BATCH:
+                break
+        if deflate:
+            yield deflate.flush()
+
+    resp = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    resp.headers["Content-Disposition"] = "attachment; filename=messages.ndjson"
+    resp.vary.add("Accept-Encoding")
+    if compress:
+        resp.content_encoding = "gzip"
+    return resp
+
+
+def _import_row(item, keep_ids, now):
+    # One NDJSON line as a messages row; raises ValueError if it isn't one.
+    if not isinstance(item, dict):
+        raise ValueError("expected a JSON object")
+    if item.get("role") not in ("user", "bot"):
+        raise ValueError("role must be 'user' or 'bot'")
+    text, audio_filename = item.get("text"), item.get("audio_filename")
+    if not isinstance(text, (str, type(None))) or not isinstance(audio_filename, (str, type(None))):
+        raise ValueError("text and audio_filename must be strings")
+    msg_id = item.get("id") if keep_ids else None
+    if keep_ids and (not isinstance(msg_id, int) or isinstance(msg_id, bool) or msg_id < 1):
+        raise ValueError("id must be a positive integer")
+    # Speech still being made when exported won't be finished by anyone.
+    tts_status = item.get("tts_status") if item.get("tts_status") in ("ready", "failed", "skipped") else None
+    return (
+        msg_id, conversation_id_from(item.get("conversation_id")), item["role"], text, audio_filename, tts_status,
+        _timestamp_arg(item, "created_at") or now,
     )
-    db.commit()
-    msg_id = cur.lastrowid
-    return jsonify({"id": msg_id, "role": role, "text": text, "audio_filename": audio_filename, "created_at": now})
 
 
-@app.route("/api/upload_audio", methods=["POST"])
+@bp.route("/api/messages/import", methods=["POST"])
+def import_messages():
+    # Bulk-loads NDJSON in the export's format (optionally gzip-encoded),
+    # read line by line and inserted IMPORT_BATCH rows per transaction, so
+    # memory stays flat for any size. Invalid lines are skipped and
+    # reported. New ids are assigned unless keep_ids=1, which keeps the
+    # exported ones and skips ids already present, so an interrupted import
+    # can be run again. Listeners get one resync per conversation touched
+    # by each batch, committed with it.
+    request.max_content_length = current_app.config["IMPORT_MAX_BYTES"]
+    keep_ids = request.args.get("keep_ids") == "1"
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    if encoding not in ("identity", "gzip"):
+        return jsonify({"error": "Content-Encoding must be gzip or identity"}), 415
+    stream = gzip.GzipFile(fileobj=request.stream, mode="rb") if encoding == "gzip" else request.stream
+    if keep_ids:
+        insert = (
+            "INSERT OR IGNORE INTO messages (id, conversation_id, role, text, audio_filename, tts_status, created_at)"
+            " SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM archive.messages WHERE id = ?)"
+        )
+    else:
+        insert = (
+            "INSERT INTO messages (conversation_id, role, text, audio_filename, tts_status, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+        )
+
+    def flush(rows):
+        events = [("resync", {}, conversation_id) for conversation_id in sorted({row[1] for row in rows})]
+
+        def do_insert(conn):
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            if keep_ids:
+                count = conn.executemany(insert, [(*row, row[0]) for row in rows]).rowcount
+            else:
+                count = conn.executemany(insert, [row[1:] for row in rows]).rowcount
+            record_events(conn, events if count else [])
+            return count
+
+        return write(do_insert)
+
+    now = datetime.utcnow().isoformat()
+    imported = valid = invalid = lines = 0
+    errors, rows = [], []
+    try:
+        while True:
+            line = stream.readline(IMPORT_MAX_LINE + 1)
+            if not line:
+                break
+            lines += 1
+            try:
+                if len(line) > IMPORT_MAX_LINE:
+                    while line and not line.endswith(b"\n"):
+                        line = stream.readline(IMPORT_MAX_LINE)
+                    raise ValueError(f"lines are limited to {IMPORT_MAX_LINE} bytes")
+                if not line.strip():
+                    continue
+                row = _import_row(current_app.json.loads(line), keep_ids, now)
+            except ValueError as e:
+                invalid += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({"line": lines, "error": str(e)})
+                continue
+            valid += 1
+            rows.append(row)
+            if len(rows) >= IMPORT_BATCH:
+                imported += flush(rows)
+                rows = []
+        if rows:
+            imported += flush(rows)
+    except (OSError, EOFError, zlib.error) as e:
+        # A corrupt gzip stream; what was committed before it stays.
+        return jsonify({"error": f"could not decode body: {e}", "imported": imported}), 400
+    return jsonify({
+        "imported": imported,
+        "skipped": valid - imported,
+        "invalid": invalid,
+        "errors": errors,
+    })
+
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+@bp.route("/api/messages/search")
+def search_messages():
+    match = search.fts_query(request.args.get("q"))
+    if match is None:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        conversation_id = conversation_id_from(request.args.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        limit = _int_arg("limit")
+    except ValueError:
+        return jsonify({"error": "limit must be a non-negative integer"}), 400
+    limit = max(1, min(limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))
+    after = None
+    if request.args.get("cursor"):
+        try:
+            after = search.decode_cursor(request.args["cursor"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    columns = ", ".join(f"m.{c.strip()}" for c in MESSAGE_COLUMNS.split(","))
+    try:
+        rows = search.search_messages(get_db(), conversation_id, match, limit + 1, after, columns)
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"invalid search: {e}"}), 400
+    results = []
+    for r in rows[:limit]:
+        msg = _message_dict(r)
+        msg["snippet"] = search.highlight(r["snippet"])
+        msg["rank"] = r["rank"]
+        results.append(msg)
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = search.encode_cursor(rows[limit - 1]["rank"], rows[limit - 1]["id"])
+    return jsonify({"results": results, "next_cursor": next_cursor})
+
+
+def _sse(kind, data, event_id=None):
+    lines = [f"event: {kind}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {current_app.json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@bp.route("/api/messages/stream")
+def message_stream():
+    # Resume point: the browser's Last-Event-ID on reconnect, else ?since_id.
+    # Insert events carry the message id as their SSE id and deletes carry
+    # none, so the resume point is always the newest message the client saw.
+    try:
+        conversation_id = conversation_id_from(request.args.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        since_id = _int_arg("since_id")
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id:
+            since_id = int(last_event_id)
+    except ValueError:
+        return jsonify({"error": "since_id and Last-Event-ID must be non-negative integers"}), 400
+
+    # Subscribe before reading the backlog so nothing committed in between
+    # can be missed; duplicates are filtered by id below.
+    subscription = broker.subscribe(conversation_id)
+    backlog = []
+    if since_id is not None:
+        backlog = _page_messages(get_db(), conversation_id, since_id=since_id, limit=MAX_PAGE_SIZE)
+
+    def generate():
+        sent_id = since_id or 0
+        yield "retry: 3000\n\n"
+        for msg in backlog:
+            sent_id = msg["id"]
+            yield _sse("insert", msg, msg["id"])
+        if len(backlog) == MAX_PAGE_SIZE:
+            # Too far behind to replay; the client reloads its view instead.
+            yield _sse("resync", {})
+
+        with subscription:
+            while True:
+                events = subscription.wait(SSE_HEARTBEAT)
+                if events is None:
+                    yield _sse("resync", {})
+                    continue
+                if not events:
+                    yield ": keep-alive\n\n"
+                    continue
+                for _, kind, data in events:
+                    if kind == "insert":
+                        if data["id"] <= sent_id:
+                            continue
+                        sent_id = data["id"]
+                        yield _sse(kind, data, data["id"])
+                    else:
+                        yield _sse(kind, data)
+
+    resp = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Also unsubscribes when the client leaves before the stream starts.
+    resp.call_on_close(subscription.close)
+    return resp
+
+
+def _accept_upload(src, ext, transcript, conversation_id, upload_id=None, digest=None):
+    # Stores the file at src as a content-addressed blob and returns its name.
+    # The message row, its forwarding job and the blob's file are committed
+    # together, so an accepted upload is never left without the work that
+    # answers it. A finished resumable upload's session goes away in the same
+    # transaction. The caller removes src.
+    folder = current_app.config["UPLOAD_FOLDER"]
+    if digest is None:
+        with stage("upload_hash"):
+            digest = blobs.file_digest(src)
+    filename = blobs.content_name(digest, ext)
+
+    def enqueue(conn, msg_id):
+        jobs.enqueue("forward_upload", {
+            "filename": filename, "transcript": transcript, "conversation_id": conversation_id,
+        }, conn)
+        if upload_id is not None:
+            conn.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+        blobs.adopt(src, folder, filename)
+
+    insert_message("user", transcript, filename, extra=enqueue, conversation_id=conversation_id)
+    jobs.wake()
+    return filename
+
+
+def _incoming_path():
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], f".incoming-{uuid.uuid4().hex}")
+
+
+@bp.route("/api/upload_audio", methods=["POST"])
+@rate_limited("uploads")
 def upload_audio():
     if "audio" not in request.files:
         return jsonify({"error": "no audio file provided"}), 400
+    try:
+        conversation_id = conversation_id_from(request.form.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    db = get_db()
+    if jobs.full(db):
+        return _queue_full_response()
     f = request.files["audio"]
-    orig_name = f.filename or "audio"
-    ext = os.path.splitext(orig_name)[1] or ".webm"
-    filename = f"{uuid.uuid4().hex}{ext}"
-    save_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    f.save(save_path)
+    incoming = _incoming_path()
+    with stage("upload_save"):
+        save_file_storage(f, incoming)
 
     transcript = request.form.get("transcript")
-    now = datetime.utcnow().isoformat()
+    try:
+        filename = _accept_upload(incoming, upload_ext(f.filename, f.mimetype), transcript, conversation_id)
+    except QueueFull:
+        return _queue_full_response()
+    finally:
+        os.remove(incoming)
+    return jsonify({"success": True, "filename": filename, "transcript": transcript})
+
+
+@bp.route("/api/upload_audio/stream", methods=["POST"])
+@rate_limited("uploads")
+def upload_audio_stream():
+    # The request body is the recording itself (no multipart); it is copied
+    # to disk and hashed as it arrives. The transcript and original filename,
+    # if any, come in the query string.
+    limit = current_app.config["MAX_UPLOAD_BYTES"]
+    if request.content_length is not None and request.content_length > limit:
+        return _too_large_response()
+    try:
+        conversation_id = conversation_id_from(request.args.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     db = get_db()
+    if jobs.full(db):
+        return _queue_full_response()
+    incoming = _incoming_path()
+    hasher = blobs.new_hasher()
+    try:
+        with stage("upload_save"), open(incoming, "wb") as out:
+            size = copy_stream(request.stream, out, limit, hasher=hasher)
+        if not size:
+            return jsonify({"error": "no audio provided"}), 400
+        transcript = request.args.get("transcript")
+        ext = upload_ext(request.args.get("filename"), request.mimetype)
+        filename = _accept_upload(incoming, ext, transcript, conversation_id, digest=hasher.hexdigest())
+    except UploadTooLarge:
+        return _too_large_response()
+    except QueueFull:
+        return _queue_full_response()
+    finally:
+        os.remove(incoming)
+    return jsonify({"success": True, "filename": filename, "transcript": transcript})
+
+
+# Resumable uploads: POST /api/uploads opens a session, each PUT appends a
+# chunk at the offset the client says it is at, GET reports how much has
+# arrived (so a client can resume after a dropped connection), and finalize
+# turns the part file into a normal upload. One lock per session keeps
+# concurrent PUTs for the same session from interleaving; an flock on the
+# part file does the same across worker processes.
+_upload_locks = {}
+_upload_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _upload_lock(upload_id):
+    with _upload_locks_guard:
+        lock = _upload_locks.setdefault(upload_id, threading.Lock())
+    with lock:
+        try:
+            fd = os.open(_part_path(upload_id), os.O_RDONLY)
+        except FileNotFoundError:
+            # Gone already; the caller finds no offset and answers 404.
+            yield
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+def _part_path(upload_id):
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], ".partial", f"{upload_id}.part")
+
+
+def _upload_offset(upload_id):
+    try:
+        return os.path.getsize(_part_path(upload_id))
+    except FileNotFoundError:
+        return None
+
+
+def _upload_offset_response(upload_id, offset, status=200):
+    resp = jsonify({"upload_id": upload_id, "offset": offset, "max_bytes": current_app.config["MAX_UPLOAD_BYTES"]})
+    resp.status_code = status
+    resp.headers["Upload-Offset"] = str(offset)
+    resp.cache_control.no_store = True
+    return resp
+
+
+def _discard_upload(db, upload_id):
+    db.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+    db.commit()
+    try:
+        os.remove(_part_path(upload_id))
+    except FileNotFoundError:
+        pass
+    with _upload_locks_guard:
+        _upload_locks.pop(upload_id, None)
+
+
+def _expire_uploads(db):
+    cutoff = (datetime.utcnow() - timedelta(seconds=current_app.config["UPLOAD_SESSION_TTL"])).isoformat()
+    for row in db.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (cutoff,)).fetchall():
+        logging.info(f"Expiring abandoned upload {row['id']}")
+        _discard_upload(db, row["id"])
+
+
+def _upload_session(db, upload_id):
+    return db.execute(
+        "SELECT id, conversation_id, ext, transcript FROM upload_sessions WHERE id = ?", (upload_id,),
+    ).fetchone()
+
+
+@bp.route("/api/uploads", methods=["POST"])
+@rate_limited("uploads")
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    size = data.get("size")
+    if isinstance(size, int) and size > current_app.config["MAX_UPLOAD_BYTES"]:
+        return _too_large_response()
+    try:
+        conversation_id = conversation_id_from(data.get("conversation_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    db = get_db()
+    if jobs.full(db):
+        return _queue_full_response()
+    _expire_uploads(db)
+
+    upload_id = uuid.uuid4().hex
+    now = datetime.utcnow().isoformat()
+    os.makedirs(os.path.dirname(_part_path(upload_id)), exist_ok=True)
+    open(_part_path(upload_id), "wb").close()
     db.execute(
-        "INSERT INTO messages (role, text, audio_filename, created_at) VALUES (?, ?, ?, ?)",
-        ("user", transcript, filename, now),
+        "INSERT INTO upload_sessions (id, conversation_id, ext, transcript, created_at, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        (upload_id, conversation_id, upload_ext(data.get("filename"), data.get("content_type")),
+         data.get("transcript"), now, now),
     )
     db.commit()
+    return _upload_offset_response(upload_id, 0, 201)
+
 
-    def background_send(file_path, orig_filename, transcript_text):
+@bp.route("/api/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    offset = _upload_offset(upload_id)
+    if offset is None or _upload_session(get_db(), upload_id) is None:
+        return jsonify({"error": "unknown upload"}), 404
+    return _upload_offset_response(upload_id, offset)
+
+
+@bp.route("/api/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    try:
+        offset = int(request.headers.get("Upload-Offset", request.args.get("offset", "")))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header must be an integer"}), 400
+    db = get_db()
+    if _upload_session(db, upload_id) is None:
+        return jsonify({"error": "unknown upload"}), 404
+
+    limit = current_app.config["MAX_UPLOAD_BYTES"]
+    with _upload_lock(upload_id):
+        current = _upload_offset(upload_id)
+        if current is None:
+            return jsonify({"error": "unknown upload"}), 404
+        if offset != current:
+            # The client is out of step (e.g. a retried chunk that did land);
+            # tell it where to continue from.
+            return _upload_offset_response(upload_id, current, 409)
+        if request.content_length is not None and current + request.content_length > limit:
+            return _too_large_response()
+        # Bytes from a chunk cut off mid-way are kept; the client resumes
+        # from whatever offset a GET reports.
+        with stage("upload_save"), open(_part_path(upload_id), "r+b") as f:
+            f.seek(current)
+            try:
+                current += copy_stream(request.stream, f, limit, already=current)
+            except UploadTooLarge:
+                f.truncate(current)
+                return _too_large_response()
+        db.execute(
+            "UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), upload_id),
+        )
+        db.commit()
+    return _upload_offset_response(upload_id, current)
+
+
+@bp.route("/api/uploads/<upload_id>", methods=["DELETE"])
+def abort_upload(upload_id):
+    db = get_db()
+    with _upload_lock(upload_id):
+        if _upload_session(db, upload_id) is None:
+            return jsonify({"error": "unknown upload"}), 404
+        _discard_upload(db, upload_id)
+    return jsonify({"success": True})
+
+
+@bp.route("/api/uploads/<upload_id>/finalize", methods=["POST"])
+def finalize_upload(upload_id):
+    data = request.get_json(silent=True) or {}
+    db = get_db()
+    with _upload_lock(upload_id):
+        session = _upload_session(db, upload_id)
+        size = _upload_offset(upload_id)
+        if session is None or size is None:
+            return jsonify({"error": "unknown upload"}), 404
+        if "size" in data and data["size"] != size:
+            return _upload_offset_response(upload_id, size, 409)
+        if not size:
+            return jsonify({"error": "no audio provided"}), 400
+
+        transcript = data.get("transcript", session["transcript"])
         try:
-            with open(file_path, "rb") as file_obj:
-                files = {"audio": (orig_filename, file_obj, "application/octet-stream")}
-                data = {"transcript": transcript_text or ""}
-                resp = requests.post(WEBHOOK_URL, files=files, data=data, timeout=60)
-                logging.info(f"Webhook POST status: {resp.status_code} / {resp.text}")
-                
-                if resp.status_code == 200:
-                    try:
-                        response_data = resp.json()
-                        bot_text = response_data.get("text") or response_data.get("response") or response_data.get("message")
-                        bot_audio = response_data.get("audio_filename")
-
-                        # ✅ Generate TTS if text exists and no audio provided
-                        if bot_text and not bot_audio:
-                            try:
-                                speech = client.text_to_speech.convert(
-                                    text=bot_text,
-                                    voice_id="EXAVITQu4vr4xnSDxMaL",
-                                    model_id="eleven_multilingual_v2"
-                                )
-                                bot_audio = f"{uuid.uuid4().hex}.mp4"
-                                audio_path = os.path.join(app.config["UPLOAD_FOLDER"], bot_audio)
-                                save(speech, audio_path)
-                            except Exception as e:
-                                logging.error(f"Failed ElevenLabs TTS: {e}")
-                                bot_audio = None
-
-                        if bot_text or bot_audio:
-                            now = datetime.utcnow().isoformat()
-                            db_conn = sqlite3.connect(app.config["DATABASE"])
-                            db_conn.row_factory = sqlite3.Row
-                            db_conn.execute(
-                                "INSERT INTO messages (role, text, audio_filename, created_at) VALUES (?, ?, ?, ?)",
-                                ("bot", bot_text, bot_audio, now),
-                            )
-                            db_conn.commit()
-                            db_conn.close()
-                    except ValueError:
-                        if resp.text.strip():
-                            now = datetime.utcnow().isoformat()
-                            db_conn = sqlite3.connect(app.config["DATABASE"])
-                            db_conn.row_factory = sqlite3.Row
-                            bot_text = resp.text.strip()
-
-                            # ✅ Generate TTS for plain text response
-                            try:
-                                speech = client.text_to_speech.convert(
-                                    text=bot_text,
-                                    voice_id="EXAVITQu4vr4xnSDxMaL",
-                                    model_id="eleven_multilingual_v2"
-                                )
-                                bot_audio = f"{uuid.uuid4().hex}.mp3"
-                                audio_path = os.path.join(app.config["UPLOAD_FOLDER"], bot_audio)
-                                save(speech, audio_path)
-                            except Exception as e:
-                                logging.error(f"Failed ElevenLabs TTS: {e}")
-                                bot_audio = None
-
-                            db_conn.execute(
-                                "INSERT INTO messages (role, text, audio_filename, created_at) VALUES (?, ?, ?, ?)",
-                                ("bot", bot_text, bot_audio, now),
-                            )
-                            db_conn.commit()
-                            db_conn.close()
-                else:
-                    logging.error(f"Webhook failed: {resp.status_code} - {resp.text}")
-        except Exception as e:
-            logging.exception("Failed to POST audio to webhook")
-
-    t = threading.Thread(target=background_send, args=(save_path, filename, transcript), daemon=True)
-    t.start()
+            filename = _accept_upload(
+                _part_path(upload_id), session["ext"], transcript, session["conversation_id"], upload_id=upload_id,
+            )
+        except QueueFull:
+            # The session is intact, so finalize can be retried later.
+            return _queue_full_response()
+        os.remove(_part_path(upload_id))
+    with _upload_locks_guard:
+        _upload_locks.pop(upload_id, None)
     return jsonify({"success": True, "filename": filename, "transcript": transcript})
 
 
-@app.route("/api/messages/<int:msg_id>", methods=["DELETE"])
-def delete_message(msg_id):
-    db = get_db()
-    cur = db.execute("SELECT audio_filename FROM messages WHERE id = ?", (msg_id,))
-    row = cur.fetchone()
-    if row is None:
-        return jsonify({"error": "message not found"}), 404
+def _queue_full_response():
+    resp = jsonify({"error": "too many uploads are waiting to be processed, try again later"})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(QUEUE_FULL_RETRY_AFTER)
+    return resp
+
+
+def _too_large_response():
+    return jsonify({"error": f"uploads are limited to {current_app.config['MAX_UPLOAD_BYTES']} bytes"}), 413
+
 
-    audio_filename = row["audio_filename"]
-    if audio_filename:
+@bp.app_errorhandler(413)
+def request_too_large(e):
+    return _too_large_response()
+
+
+def forward_upload(job):
+    # Job handler: posts an uploaded recording to the webhook and stores the
+    # bot reply. Raising makes the queue retry with backoff. The reply is
+    # keyed by the job, so a run replayed after its reply was stored (e.g.
+    # its process died before finishing the job) doesn't store it twice.
+    reply_key = f"job:{job.id}"
+    if idempotency.seen(storage.pool.get(current_app.config["DATABASE"]), reply_key, current_app.config["IDEMPOTENCY_TTL"]):
+        logging.info(f"Reply for job {job.id} already stored, skipping")
+        return
+    file_path = blobs.locate(current_app.config["UPLOAD_FOLDER"], job.payload["filename"])
+    transcript_text = job.payload["transcript"]
+    try:
+        if file_path is None:
+            raise FileNotFoundError(job.payload["filename"])
+        file_obj = open(file_path, "rb")
+    except FileNotFoundError:
+        raise PermanentJobError(f"upload {job.payload['filename']} no longer exists")
+    with file_obj:
+        files = {"audio": (job.payload["filename"], file_obj, "application/octet-stream")}
+        # n8n echoes conversation_id back to /api/webhook_receive for replies
+        # it sends later, so they land in the same conversation.
+        conversation_id = job.payload.get("conversation_id", DEFAULT_CONVERSATION)
+        data = {"transcript": transcript_text or "", "conversation_id": conversation_id}
         try:
-            file_path = os.path.join(app.config["UPLOAD_FOLDER"], audio_filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception:
-            logging.exception("Failed to remove audio file for message %s", msg_id)
+            with budgets["webhook"].slot(), stage("webhook"):
+                resp = get_webhook().post(files=files, data=data)
+        except (CircuitOpen, Overloaded) as e:
+            # The webhook is known to be down, or enough calls to it are
+            # already in flight: wait without using up one of the job's
+            # attempts.
+            raise RetryLater(e.retry_after, str(e))
+        logging.info(f"Webhook POST status: {resp.status_code} / {resp.text}")
+
+    if resp.status_code != 200:
+        logging.error(f"Webhook failed: {resp.status_code} - {resp.text}")
+        if 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+            raise PermanentJobError(f"webhook rejected upload with {resp.status_code}")
+        raise RuntimeError(f"webhook returned {resp.status_code}")
 
-    db.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
-    db.commit()
+    try:
+        response_data = resp.json()
+        bot_text = response_data.get("text") or response_data.get("response") or response_data.get("message")
+        bot_audio = response_data.get("audio_filename")
+    except ValueError:
+        bot_text = resp.text.strip()
+        bot_audio = None
+    if not bot_text and not bot_audio:
+        return
+
+    try:
+        insert_reply("bot", bot_text, bot_audio, conversation_id, idempotency_key=reply_key)
+    except idempotency.Replayed:
+        logging.info(f"Reply for job {job.id} already stored")
+
+
+@bp.route("/api/messages/<int:msg_id>", methods=["DELETE"])
+def delete_message(msg_id):
+    # The audio file is only removed once no other message shares it.
+    def do_delete(conn):
+        if not conn.in_transaction:
+            # Take the write lock before reading, so audio_filename can't
+            # change between the read and the delete.
+            conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT conversation_id, audio_filename FROM messages WHERE id = ?", (msg_id,)).fetchone()
+        if row is None:
+            conversation_id = archive.delete_message(conn, msg_id)
+            if conversation_id is None:
+                return None
+        else:
+            conversation_id = row["conversation_id"]
+            conn.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+            if row["audio_filename"]:
+                blobs.release(conn, current_app.config["UPLOAD_FOLDER"], row["audio_filename"])
+        record_events(conn, [("delete", {"id": msg_id, "conversation_id": conversation_id}, conversation_id)])
+        return conversation_id
+
+    if write(do_delete) is None:
+        return jsonify({"error": "message not found"}), 404
     return jsonify({"success": True})
 
 
-@app.route("/api/webhook_receive", methods=["POST"])
+def _timestamp_arg(data, name):
+    value = data.get(name)
+    if value is None:
+        return None
+    try:
+        ts = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an ISO 8601 timestamp")
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts.isoformat()
+
+
+@bp.route("/api/messages", methods=["DELETE"])
+def delete_messages():
+    # Deletes by id list ({ids: [...]}) or by a range within one conversation
+    # ({conversation_id, from_id, to_id, since, until}; bounds inclusive,
+    # `until` exclusive) in one transaction, archived messages included.
+    # Files that lose their last reference are unlinked by a background job,
+    # not on the request path.
+    data = request.get_json(force=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    ids = data.get("ids")
+    if ids is not None:
+        if not isinstance(ids, list) or not ids:
+            return jsonify({"error": "ids must be a non-empty list"}), 400
+        if len(ids) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"at most {MAX_BATCH_SIZE} ids per request"}), 400
+        if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({"error": "ids must be integers"}), 400
+        where, params = ["id IN (SELECT value FROM json_each(?))"], [json.dumps(ids)]
+    else:
+        try:
+            conversation_id = conversation_id_from(data.get("conversation_id"))
+            since, until = _timestamp_arg(data, "since"), _timestamp_arg(data, "until")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        where, params = ["conversation_id = ?"], [conversation_id]
+        for name, clause in (("from_id", "id >= ?"), ("to_id", "id <= ?")):
+            value = data.get(name)
+            if value is None:
+                continue
+            if not isinstance(value, int) or isinstance(value, bool):
+                return jsonify({"error": f"{name} must be an integer"}), 400
+            where.append(clause)
+            params.append(value)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created_at < ?")
+            params.append(until)
+        if len(where) == 1:
+            return jsonify({"error": "give ids, or at least one of from_id, to_id, since and until"}), 400
+    where = " AND ".join(where)
+    # Archived messages have their audio in a bundle, so there is no file to
+    # release for them.
+    select = (f"SELECT id, conversation_id, audio_filename, 0 AS archived FROM messages WHERE {where}"
+              f" UNION ALL SELECT id, conversation_id, NULL, 1 FROM archive.messages WHERE {where}"
+              " ORDER BY id LIMIT ?")
+    params = [*params, *params, MAX_BATCH_SIZE + 1]
+
+    def do_delete(conn):
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(select, params).fetchall()
+        more = len(rows) > MAX_BATCH_SIZE
+        rows = rows[:MAX_BATCH_SIZE]
+        conn.executemany("DELETE FROM messages WHERE id = ?", [(r["id"],) for r in rows if not r["archived"]])
+        for r in rows:
+            if r["archived"]:
+                archive.delete_message(conn, r["id"])
+        names = sorted({r["audio_filename"] for r in rows if r["audio_filename"]})
+        if names:
+            try:
+                jobs.enqueue("release_blobs", {"names": names}, conn)
+            except QueueFull:
+                # Their refcounts are already 0; the orphan sweeper gets them.
+                logging.warning(f"Job queue full, leaving {len(names)} file(s) to the orphan sweeper")
+        record_events(conn, [
+            ("delete", {"id": r["id"], "conversation_id": r["conversation_id"]}, r["conversation_id"]) for r in rows
+        ])
+        return rows, more
+
+    rows, more = write(do_delete)
+    jobs.wake()
+    if ids is not None:
+        deleted = {r["id"] for r in rows}
+        results = [{"id": i, "deleted": True} if i in deleted else
+                   {"id": i, "deleted": False, "error": "message not found"} for i in ids]
+    else:
+        results = [{"id": r["id"], "deleted": True} for r in rows]
+    return jsonify({"deleted": len(rows), "more": more, "results": results})
+
+
+def release_blobs(job):
+    # Job handler: unlinks files left unreferenced by a bulk delete, in one
+    # transaction. Names re-used since then have a refcount again and stay.
+    folder = current_app.config["UPLOAD_FOLDER"]
+
+    def do_release(conn):
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        return sum(blobs.release(conn, folder, name) for name in job.payload["names"])
+
+    freed = write(do_release)
+    if freed:
+        logging.info(f"Released {freed} bytes of audio from deleted messages")
+
+
+@bp.route("/api/webhook_receive", methods=["POST"])
+@rate_limited("webhook_receive")
 def webhook_receive():
     try:
         data = request.get_json(force=True)
+        # n8n retries deliveries it didn't see answered; with a key, every
+        # retry gets the first delivery's response and nothing is stored twice.
+        key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+        if key is not None and not (isinstance(key, str) and 0 < len(key) <= idempotency.MAX_KEY_LENGTH):
+            return jsonify({"error": f"idempotency key must be 1-{idempotency.MAX_KEY_LENGTH} characters"}), 400
         role = data.get("role", "bot")
         text = data.get("text")
         audio_filename = data.get("audio_filename")
-
-        # ✅ Generate TTS if only text is provided
-        if text and not audio_filename:
-            try:
-                speech = client.text_to_speech.convert(
-                    text=text,
-                    voice_id="EXAVITQu4vr4xnSDxMaL",
-                    model_id="eleven_multilingual_v2"
-                )
-                audio_filename = f"{uuid.uuid4().hex}.mp3"
-                audio_path = os.path.join(app.config["UPLOAD_FOLDER"], audio_filename)
-                save(speech, audio_path)
-            except Exception as e:
-                logging.error(f"Failed ElevenLabs TTS: {e}")
-                audio_filename = None
+        try:
+            conversation_id = conversation_id_from(data.get("conversation_id"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         if not text and not audio_filename:
             return jsonify({"error": "must include 'text' or 'audio_filename'"}), 400
 
-        now = datetime.utcnow().isoformat()
-        db = get_db()
-        cur = db.execute(
-            "INSERT INTO messages (role, text, audio_filename, created_at) VALUES (?, ?, ?, ?)",
-            (role, text, audio_filename, now),
-        )
-        db.commit()
-        msg_id = cur.lastrowid
-
-        return jsonify({
-            "success": True,
-            "id": msg_id,
-            "role": role,
-            "text": text,
-            "audio_filename": audio_filename,
-            "created_at": now
-        })
+        # Text-only messages are stored immediately; their speech is
+        # synthesized in the background and arrives as an update.
+        try:
+            msg = insert_reply(
+                role, text, audio_filename, conversation_id,
+                idempotency_key=None if key is None else f"webhook:{key}",
+                fingerprint=idempotency.fingerprint({k: v for k, v in data.items() if k != "idempotency_key"}),
+            )
+        except idempotency.Replayed as e:
+            resp = jsonify({"success": True, **e.response})
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+        except idempotency.KeyReused as e:
+            return jsonify({"error": str(e)}), 422
+        return jsonify({"success": True, **msg})
     except Exception as e:
         logging.exception("Failed to handle incoming webhook data")
         return jsonify({"error": str(e)}), 500
 
 
-if __name__ == "__main__":
+@bp.route("/api/jobs/stats")
+def job_stats():
+    return jsonify(jobs.stats(get_db()))
+
+
+@bp.route("/api/tts/stats")
+def tts_stats():
+    return jsonify(get_tts().stats())
+
+
+@bp.route("/api/webhook/stats")
+def webhook_stats():
+    return jsonify(get_webhook().stats())
+
+
+@bp.route("/api/gc/stats")
+def gc_stats():
+    return jsonify(sweeper.stats())
+
+
+@bp.route("/api/limits/stats")
+def limits_stats():
+    return jsonify({
+        "rate_limits": {name: limiter.stats() for name, limiter in limiters.items()},
+        "budgets": {name: budget.stats() for name, budget in budgets.items()},
+    })
+
+
+@bp.route("/api/archive/stats")
+def archive_stats():
+    return jsonify(archiver.stats())
+
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=Registry.CONTENT_TYPE)
+
+
+def _process_id():
+    # Computed per call: prefork servers fork after the app is imported.
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _lease_holder(get_conn, name, interval):
+    # Every process runs the periodic thread, but only the holder of this
+    # lease does the work. It outlives one interval, so the holder keeps it
+    # by running.
+    def should_run():
+        return storage.acquire_lease(get_conn(), name, _process_id(), 2 * interval)
+    return should_run
+
+
+def _admission_counter(gate):
+    return lambda admitted: admissions_total.inc(gate=gate, outcome="admitted" if admitted else "shed")
+
+
+def _in_context(app, handler):
+    # Job handlers run on worker threads, which have no app context of their own.
+    @functools.wraps(handler)
+    def run(job):
+        with app.app_context():
+            return handler(job)
+    return run
+
+
+def _build_services(app):
+    config = app.config
+    services = _Services()
+    app.json = provider_for(config["JSON_PROVIDER"])(app)
+    storage.pool.on_connect[config["DATABASE"]] = functools.partial(_attach_archive, config)
+    get_conn = lambda: storage.pool.get(config["DATABASE"])
+    services.jobs = JobQueue(
+        get_conn,
+        workers=config["JOB_WORKERS"],
+        max_pending=config["JOB_QUEUE_MAX"],
+        max_attempts=config["JOB_MAX_ATTEMPTS"],
+        lease=config["JOB_LEASE"],
+        on_finish=_job_finished,
+    )
+    for kind, handler in (
+        ("forward_upload", forward_upload),
+        ("synthesize_speech", synthesize_speech),
+        ("release_blobs", release_blobs),
+    ):
+        services.jobs.register(kind, _in_context(app, handler))
+    services.sweeper = OrphanSweeper(
+        get_conn,
+        lambda: config["UPLOAD_FOLDER"],
+        interval=config["GC_INTERVAL"],
+        grace=config["GC_GRACE"],
+        max_ops=config["GC_MAX_OPS"],
+        should_run=_lease_holder(get_conn, "orphan-sweeper", config["GC_INTERVAL"]),
+    )
+    services.archiver = archive.Archiver(
+        get_conn,
+        lambda: config["UPLOAD_FOLDER"],
+        _archive_dir(config),
+        days=config["ARCHIVE_AFTER_DAYS"],
+        interval=config["ARCHIVE_INTERVAL"],
+        batch=config["ARCHIVE_BATCH"],
+        bundle_max_bytes=config["ARCHIVE_BUNDLE_MAX_BYTES"],
+        should_run=_lease_holder(get_conn, "archiver", config["ARCHIVE_INTERVAL"]),
+    )
+    for name, rate, burst in (
+        ("uploads", config["UPLOAD_RATE"], config["UPLOAD_BURST"]),
+        ("webhook_receive", config["WEBHOOK_RECEIVE_RATE"], config["WEBHOOK_RECEIVE_BURST"]),
+    ):
+        services.limiters[name] = RateLimiter(rate / 60, burst, on_admission=_admission_counter(name))
+    for name, limit in (("webhook", config["WEBHOOK_MAX_CONCURRENCY"]), ("tts", config["TTS_MAX_CONCURRENCY"])):
+        services.budgets[name] = Budget(
+            get_conn, f"budget-{name}", limit,
+            ttl=config["CONCURRENCY_SLOT_TTL"], on_admission=_admission_counter(name),
+        )
+    if config["EVENT_LOG"]:
+        services.relay = EventRelay(
+            services.broker, get_conn,
+            poll_interval=config["EVENT_POLL_INTERVAL"],
+            retention=config["EVENT_RETENTION"],
+        )
+    if config["GROUP_COMMIT"]:
+        services.writer = storage.GroupCommitWriter(
+            config["DATABASE"],
+            max_batch=config["GROUP_COMMIT_MAX_BATCH"],
+            max_delay=config["GROUP_COMMIT_MAX_DELAY_MS"] / 1000,
+            on_connect=functools.partial(_attach_archive, config),
+            on_commit=functools.partial(_publish_batch, services.broker),
+        )
+    app.extensions["chat"] = services
+
+
+def create_app(config=None):
+    """Build the app: `config` over the environment defaults.
+
+    Each app gets its own job queue, sweeper, archiver, event relay and
+    TTS/webhook clients, and creates or upgrades its schema. Nothing is
+    started; call start_background(app) in every serving process.
+    """
+    app = Flask(__name__)
+    app.request_class = UploadRequest
+    _configure(app)
+    if config:
+        app.config.update(config)
+        if "MAX_UPLOAD_BYTES" in config and "MAX_CONTENT_LENGTH" not in config:
+            app.config["MAX_CONTENT_LENGTH"] = app.config["MAX_UPLOAD_BYTES"] + 64 * 1024
+    app.register_blueprint(bp)
+    app.teardown_appcontext(close_connection)
+    _build_services(app)
+    with app.app_context():
+        init_db()
+    # Don't hand this thread's connection to processes forked from here.
+    storage.pool.close()
+    return app
+
+
+def start_background(app):
+    # Job workers, the orphan sweeper, the archiver and the event relay are
+    # threads, so every serving process starts its own (after forking, never
+    # before).
+    services = app.extensions["chat"]
+    services.jobs.start()
+    services.sweeper.start()
+    services.archiver.start()
+    if services.relay is not None:
+        services.relay.start()
+
+
+def __getattr__(name):
+    # `flask --app app` and `from app import app` get an app built from the
+    # environment on first use; importing the module builds nothing.
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@bp.cli.command("dedup-uploads")
+@click.option("--dry-run", is_flag=True, help="Only report what would change.")
+def dedup_uploads_command(dry_run):
+    """Rename stored audio to content hashes, merging identical files.
+
+    Content-named files still stored flat are moved into their shard.
+    """
     init_db()
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    folder = current_app.config["UPLOAD_FOLDER"]
+    db = storage.pool.get(current_app.config["DATABASE"])
+    names = [r["name"] for r in db.execute("SELECT name FROM blobs WHERE refcount > 0 ORDER BY name")]
+    renamed = merged = sharded = missing = freed = 0
+    planned = set()
+    for name in names:
+        path = blobs.locate(folder, name)
+        if path is None:
+            missing += 1
+            continue
+        if blobs.is_content_name(name):
+            if path != blobs.blob_path(folder, name):
+                if not dry_run:
+                    os.makedirs(os.path.dirname(blobs.blob_path(folder, name)), exist_ok=True)
+                    os.replace(path, blobs.blob_path(folder, name))
+                sharded += 1
+            continue
+        size = os.path.getsize(path)
+        new_name = blobs.content_name(blobs.file_digest(path), upload_ext(name, default=".bin"))
+        if dry_run:
+            duplicate = new_name in planned or blobs.locate(folder, new_name) is not None
+            planned.add(new_name)
+        else:
+            def rename(conn):
+                created = blobs.adopt(path, folder, new_name)
+                conn.execute("UPDATE messages SET audio_filename = ? WHERE audio_filename = ?", (new_name, name))
+                conn.execute(
+                    "UPDATE jobs SET payload = json_set(payload, '$.filename', ?)"
+                    " WHERE kind = 'forward_upload' AND json_extract(payload, '$.filename') = ?",
+                    (new_name, name),
+                )
+                blobs.release(conn, folder, name)
+                return not created
+
+            duplicate = write(rename)
+        if duplicate:
+            merged += 1
+            freed += size
+        else:
+            renamed += 1
+    verb = "would be" if dry_run else "were"
+    click.echo(f"{renamed} file(s) {verb} renamed, {merged} duplicate(s) {verb} merged ({freed} bytes), "
+               f"{sharded} {verb} moved into shards, {missing} referenced file(s) missing")
+
+
+@bp.cli.command("gc-uploads")
+@click.option("--grace", type=float, default=None, help="Minimum file age in seconds (default GC_GRACE).")
+def gc_uploads_command(grace):
+    """Remove unreferenced files from the upload folder now."""
+    init_db()
+    if grace is not None:
+        sweeper.grace = grace
+    report = sweeper.run_once()
+    click.echo(f"Scanned {report['scanned']} file(s): removed {report['removed']} orphan(s), "
+               f"reclaimed {report['reclaimed_bytes']} bytes; {report['missing']} referenced file(s) missing")
+
+
+@bp.cli.command("search-backfill")
+@click.option("--rebuild", is_flag=True, help="Re-index every message from scratch.")
+def search_backfill_command(rebuild):
+    """Build the full-text search index for an existing database."""
+    started = time.monotonic()
+    init_db()  # migration 7 indexes the rows already there
+    conn = storage.pool.get(current_app.config["DATABASE"])
+    if rebuild:
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    click.echo(f"Indexed {count} message(s) in {time.monotonic() - started:.1f}s")
+
+
+@bp.cli.command("archive")
+@click.option("--days", type=float, help="Archive messages older than this (default: ARCHIVE_AFTER_DAYS).")
+@click.option("--vacuum", is_flag=True, help="VACUUM chat.db afterwards to return the freed space to the OS.")
+def archive_command(days, vacuum):
+    """Move old messages and their audio to the archive now."""
+    init_db()
+    days = current_app.config["ARCHIVE_AFTER_DAYS"] if days is None else days
+    if not days:
+        raise click.UsageError("set ARCHIVE_AFTER_DAYS or pass --days")
+    report = archiver.run_once(days)
+    click.echo(f"Archived {report['messages']} message(s) and {report['blobs']} audio file(s) "
+               f"({report['bytes']} bytes, {report['stored_bytes']} in bundles); "
+               f"freed {report['freed_bytes']} bytes from {current_app.config['UPLOAD_FOLDER']}")
+    if report["missing"]:
+        click.echo(f"{report['missing']} audio file(s) were already missing")
+    if vacuum:
+        storage.pool.get(current_app.config["DATABASE"]).execute("VACUUM main")
+        click.echo("Vacuumed")
+
+
+if __name__ == "__main__":
+    app = create_app()
+    debug = True
+    # The debug reloader runs this file in a watcher and a serving child;
+    # only the child should work the job queue.
+    if not debug or is_running_from_reloader():
+        start_background(app)
+    app.run(host="0.0.0.0", port=5000, debug=debug)
 
 
 
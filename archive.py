@@ -0,0 +1,341 @@
+import io
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import blobs
+
+try:
+    import fcntl
+except ImportError:  # Windows: rely on the archiver lease alone
+    fcntl = None
+
+
+# Cold storage for old messages, kept out of chat.db and uploads/ so the hot
+# tables, their backups and VACUUM stay proportional to recent traffic.
+# Archived rows live in a separate SQLite file ATTACHed to every connection
+# as `archive`, with the same columns as `messages`. Their audio is appended
+# to per-month bundle files; `archive.blobs` maps each name to its bundle,
+# byte offset (`start`) and length, so a single clip is read with one seek.
+# Bundles are append-only: deleting an archived message doesn't shrink them.
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS archive.messages (
+        id INTEGER PRIMARY KEY,
+        conversation_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT,
+        audio_filename TEXT,
+        audio_segments TEXT,
+        tts_status TEXT,
+        created_at TEXT NOT NULL,
+        archived_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.messages_conversation_id ON messages (conversation_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS archive.conversation_counts (
+        conversation_id TEXT PRIMARY KEY,
+        row_count INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.blobs (
+        name TEXT PRIMARY KEY,
+        bundle TEXT NOT NULL,
+        start INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        codec TEXT NOT NULL,
+        archived_at REAL NOT NULL
+    )
+    """,
+)
+
+COLUMNS = "id, conversation_id, role, text, audio_filename, audio_segments, tts_status, created_at"
+
+# Audio is usually compressed already; only keep the deflated copy when it
+# saves at least this fraction.
+MIN_SAVING = 0.05
+
+
+def attach(conn, path):
+    """ATTACH the archive database at `path` as `archive` and create its tables."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    conn.execute("PRAGMA archive.journal_mode = WAL")
+    conn.execute("PRAGMA archive.synchronous = NORMAL")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def archived_count(conn, conversation_id):
+    row = conn.execute(
+        "SELECT row_count FROM archive.conversation_counts WHERE conversation_id = ?", (conversation_id,),
+    ).fetchone()
+    return row["row_count"] if row else 0
+
+
+def find_blob(conn, name):
+    return conn.execute(
+        "SELECT bundle, start, length, size, codec, archived_at FROM archive.blobs WHERE name = ?", (name,),
+    ).fetchone()
+
+
+def open_blob(directory, row):
+    """Open an archived clip; returns (file, start offset of the clip in it).
+
+    Stored clips are read straight from the bundle, deflated ones are
+    inflated into memory.
+    """
+    f = open(os.path.join(directory, row["bundle"]), "rb")
+    if row["codec"] == "raw":
+        return f, row["start"]
+    with f:
+        f.seek(row["start"])
+        data = zlib.decompress(f.read(row["length"]))
+    return io.BytesIO(data), 0
+
+
+def delete_message(conn, msg_id):
+    """Delete an archived message in the caller's transaction.
+
+    Returns its conversation_id, or None if there is no such message. Its
+    audio stays in the bundle. The conversation's hot stats get a new
+    version like any other delete, so GET /api/messages validators change.
+    """
+    row = conn.execute("SELECT conversation_id FROM archive.messages WHERE id = ?", (msg_id,)).fetchone()
+    if row is None:
+        return None
+    conn.execute("DELETE FROM archive.messages WHERE id = ?", (msg_id,))
+    conn.execute(
+        "UPDATE archive.conversation_counts SET row_count = row_count - 1 WHERE conversation_id = ?",
+        (row["conversation_id"],),
+    )
+    conn.execute(
+        "UPDATE message_stats SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+        " WHERE id = 1"
+    )
+    conn.execute(
+        "INSERT INTO conversation_stats (conversation_id, row_count, max_id, version, changed_at)"
+        " SELECT ?, 0, 0, version, changed_at FROM message_stats WHERE id = 1"
+        " ON CONFLICT (conversation_id) DO UPDATE SET version = excluded.version, changed_at = excluded.changed_at",
+        (row["conversation_id"],),
+    )
+    return row["conversation_id"]
+
+
+class Archiver:
+    """Moves messages older than `days` days from the hot tables to the archive.
+
+    Each run walks the messages created before the cutoff in (created_at,
+    id) order, in batches of `batch`, through the created_at index. Ids
+    don't follow creation time: imported messages get new ids.
+    A batch's audio is appended to the bundle for its month first, outside
+    any transaction. Then one transaction records the bundle offsets, copies
+    the rows into `archive.messages` and deletes them from `messages`. The
+    usual triggers keep conversation stats and blob refcounts right, and
+    nothing is published: the messages haven't gone away. Files no hot
+    message references any more are unlinked afterwards. Messages whose
+    speech is still being made are left for a later run.
+    """
+
+    def __init__(self, get_conn, get_upload_dir, directory, days, interval=3600.0, batch=500,
+                 bundle_max_bytes=1024 ** 3, should_run=None):
+        self.get_conn = get_conn
+        self.get_upload_dir = get_upload_dir
+        self.directory = directory
+        self.days = days
+        self.interval = interval
+        self.batch = batch
+        self.bundle_max_bytes = bundle_max_bytes
+        self.should_run = should_run
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.archived = 0
+        self.archived_bytes = 0
+        self.last_run = None
+
+    def start(self):
+        if self._thread is not None or not self.interval or not self.days:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "archived": self.archived,
+            "archived_bytes": self.archived_bytes,
+            "last_run": self.last_run,
+        }
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if self.should_run is None or self.should_run():
+                    self.run_once()
+            except Exception:
+                logging.exception("Archive run failed")
+
+    def run_once(self, days=None):
+        """Archive messages older than `days` (default: the configured
+        retention) and return a report of what moved.
+        """
+        started = time.monotonic()
+        days = self.days if days is None else days
+        cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        conn = self.get_conn()
+        report = {"messages": 0, "blobs": 0, "bytes": 0, "stored_bytes": 0, "missing": 0, "freed_bytes": 0}
+        after = ("", 0)
+        while not self._stop.is_set():
+            # Keyed on the last row seen: rows left behind (speech still
+            # being made) aren't read again.
+            rows = conn.execute(
+                "SELECT id, audio_filename, tts_status, created_at FROM messages"
+                " WHERE created_at < ? AND (created_at, id) > (?, ?) ORDER BY created_at, id LIMIT ?",
+                (cutoff, *after, self.batch),
+            ).fetchall()
+            conn.commit()
+            due = [row for row in rows if row["tts_status"] not in ("pending", "partial")]
+            if due:
+                self._archive(conn, due, report)
+            if len(rows) < self.batch:
+                break
+            after = (rows[-1]["created_at"], rows[-1]["id"])
+
+        report["duration"] = round(time.monotonic() - started, 3)
+        self.runs += 1
+        self.archived += report["messages"]
+        self.archived_bytes += report["bytes"]
+        self.last_run = report
+        logging.info(f"Archived {report['messages']} message(s) and {report['blobs']} audio file(s), "
+                     f"freed {report['freed_bytes']} bytes from the upload folder")
+        return report
+
+    def _archive(self, conn, rows, report):
+        upload_dir = self.get_upload_dir()
+        packed = []
+        seen = set()
+        for row in rows:
+            name = row["audio_filename"]
+            if not name or name in seen:
+                continue
+            seen.add(name)
+            if find_blob(conn, name) is not None:
+                continue
+            path = blobs.locate(upload_dir, name)
+            if path is None:
+                report["missing"] += 1
+                continue
+            packed.append((name, *self._pack(path, row["created_at"][:7])))
+        conn.commit()
+
+        ids = [row["id"] for row in rows]
+        placeholders = ",".join("?" * len(ids))
+        now = datetime.utcnow().isoformat()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO archive.blobs (name, bundle, start, length, size, codec, archived_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*entry, time.time()) for entry in packed],
+            )
+            # Rows still present (not deleted meanwhile) and not already
+            # copied by a run that was cut short.
+            counts = dict(conn.execute(
+                f"SELECT conversation_id, COUNT(*) FROM main.messages WHERE id IN ({placeholders})"
+                " AND id NOT IN (SELECT id FROM archive.messages) GROUP BY conversation_id",
+                ids,
+            ).fetchall())
+            conn.execute(
+                f"INSERT OR IGNORE INTO archive.messages ({COLUMNS}, archived_at)"
+                f" SELECT {COLUMNS}, ? FROM main.messages WHERE id IN ({placeholders})",
+                [now, *ids],
+            )
+            conn.executemany(
+                "INSERT INTO archive.conversation_counts (conversation_id, row_count) VALUES (?, ?)"
+                " ON CONFLICT (conversation_id) DO UPDATE SET row_count = row_count + excluded.row_count",
+                list(counts.items()),
+            )
+            conn.execute(f"DELETE FROM main.messages WHERE id IN ({placeholders})", ids)
+            unreferenced = [
+                name for name in sorted(seen)
+                if conn.execute("DELETE FROM main.blobs WHERE name = ? AND refcount <= 0", (name,)).rowcount
+            ]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        report["messages"] += sum(counts.values())
+        report["blobs"] += len(packed)
+        report["bytes"] += sum(entry[4] for entry in packed)
+        report["stored_bytes"] += sum(entry[3] for entry in packed)
+        if unreferenced:
+            report["freed_bytes"] += self._unlink(conn, upload_dir, unreferenced)
+
+    def _unlink(self, conn, upload_dir, names):
+        # Re-check under the write lock: an upload may have stored the same
+        # audio again since the transaction above.
+        freed = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name in names:
+                if conn.execute("SELECT 1 FROM main.blobs WHERE name = ?", (name,)).fetchone():
+                    continue
+                path = blobs.locate(upload_dir, name)
+                if path is not None:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return freed
+
+    def _bundle_for(self, month):
+        # <YYYY-MM>.pack, then <YYYY-MM>.2.pack and so on once one is full.
+        n = 1
+        while True:
+            name = f"{month}.pack" if n == 1 else f"{month}.{n}.pack"
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getsize(path) < self.bundle_max_bytes:
+                    return name, path
+            except FileNotFoundError:
+                return name, path
+            n += 1
+
+    def _pack(self, path, month):
+        # Appends one clip to its month's bundle and fsyncs it, so the offsets
+        # recorded afterwards always point at durable bytes. Returns
+        # (bundle, offset, length, size, codec).
+        with open(path, "rb") as f:
+            data = f.read()
+        deflated = zlib.compress(data, 6)
+        if len(deflated) <= len(data) * (1 - MIN_SAVING):
+            payload, codec = deflated, "zlib"
+        else:
+            payload, codec = data, "raw"
+        os.makedirs(self.directory, exist_ok=True)
+        bundle, bundle_path = self._bundle_for(month)
+        with open(bundle_path, "ab") as out:
+            if fcntl is not None:
+                fcntl.flock(out.fileno(), fcntl.LOCK_EX)
+            offset = out.seek(0, os.SEEK_END)
+            out.write(payload)
+            out.flush()
+            os.fsync(out.fileno())
+        return bundle, offset, len(payload), len(data), codec
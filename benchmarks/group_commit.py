@@ -0,0 +1,95 @@
+"""Compare message insert throughput: per-statement commits vs group commit.
+
+    python -m benchmarks.group_commit --threads 16 --rows 2000
+
+Each writer thread inserts --rows messages. "per-statement" gives every
+thread its own pooled connection and commits after each INSERT, like the
+request handlers do by default; "group-commit" sends every insert through
+storage.GroupCommitWriter. Run with --synchronous FULL to see the effect
+when each commit is a real fsync.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import storage
+
+INSERT = "INSERT INTO messages (role, text, audio_filename, created_at) VALUES (?, ?, ?, ?)"
+
+
+def _pragmas(synchronous):
+    return storage.PRAGMAS + (f"PRAGMA synchronous = {synchronous}",)
+
+
+def _fresh_db(directory, name):
+    path = os.path.join(directory, name)
+    conn = storage.connect(path)
+    storage.migrate(conn)
+    conn.close()
+    return path
+
+
+def _run_threads(threads, fn):
+    workers = [threading.Thread(target=fn) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start
+
+
+def per_statement(path, threads, rows, synchronous):
+    def work():
+        conn = storage.connect(path, _pragmas(synchronous))
+        for i in range(rows):
+            conn.execute(INSERT, ("bot", f"message {i}", None, datetime.utcnow().isoformat()))
+            conn.commit()
+        conn.close()
+
+    return _run_threads(threads, work)
+
+
+def group_commit(path, threads, rows, synchronous, max_batch, max_delay):
+    writer = storage.GroupCommitWriter(path, max_batch=max_batch, max_delay=max_delay,
+                                       pragmas=_pragmas(synchronous))
+
+    def work():
+        for i in range(rows):
+            writer.run(lambda conn: conn.execute(
+                INSERT, ("bot", f"message {i}", None, datetime.utcnow().isoformat())
+            ).lastrowid)
+
+    elapsed = _run_threads(threads, work)
+    writer.stop()
+    return elapsed, writer.batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=1000, help="inserts per thread")
+    parser.add_argument("--synchronous", default="NORMAL", choices=["OFF", "NORMAL", "FULL"])
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-delay-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    total = args.threads * args.rows
+    with tempfile.TemporaryDirectory() as d:
+        path = _fresh_db(d, "per_statement.db")
+        elapsed = per_statement(path, args.threads, args.rows, args.synchronous)
+        print(f"per-statement commit: {total / elapsed:10.0f} inserts/s ({total} rows in {elapsed:.2f}s)")
+
+        path = _fresh_db(d, "group_commit.db")
+        elapsed, batches = group_commit(
+            path, args.threads, args.rows, args.synchronous, args.max_batch, args.max_delay_ms / 1000
+        )
+        print(f"group commit:         {total / elapsed:10.0f} inserts/s ({total} rows in {elapsed:.2f}s, "
+              f"{batches} commits, {total / batches:.1f} rows/commit)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Measure the size and serialization time of a GET /api/messages page.
+
+    python -m benchmarks.json_response --messages 100 --text-chars 600
+
+Fills a temporary database with one conversation of --messages messages
+with --text-chars character transcripts, then builds one page of all of
+them --repeat times per variant: the previous path (sqlite3.Row rows,
+dicts built per row, Flask's default JSON provider), tuple rows with the
+compact json module and orjson providers, a ?fields= projection, and gzip
+on top at the app's level. Reports the median time and the bytes on the
+wire for each.
+"""
+import argparse
+import gzip
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from flask.json.provider import DefaultJSONProvider
+
+from jsonprovider import CompactJSONProvider, OrjsonProvider, orjson
+
+WORDS = ("the", "audio", "message", "reply", "speech", "conversation", "upload", "tomorrow", "weather", "could",
+         "please", "schedule", "meeting", "thanks", "question", "answer", "señal", "mañana", "größe", "café")
+
+
+def build(conn, messages, text_chars):
+    now = datetime.utcnow().isoformat()
+    rows = []
+    for i in range(messages):
+        text = ""
+        while len(text) < text_chars:
+            text += random.choice(WORDS) + " "
+        rows.append(("bench", random.choice(("user", "bot")), text.strip(), f"{i:064x}.mp3", "ready", now))
+    conn.executemany(
+        "INSERT INTO messages (conversation_id, role, text, audio_filename, tts_status, created_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100, help="messages on the page")
+    parser.add_argument("--text-chars", type=int, default=600, help="transcript length")
+    parser.add_argument("--fields", default="text,role,tts_status", help="projection for the ?fields= variants")
+    parser.add_argument("--repeat", type=int, default=300)
+    args = parser.parse_args()
+
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as d:
+        from app import COMPRESS_LEVEL, MESSAGE_FIELDS, _message_dict, _page_messages, create_app, storage
+
+        app = create_app({"DATABASE": os.path.join(d, "chat.db"), "UPLOAD_FOLDER": os.path.join(d, "uploads")})
+        conn = storage.pool.get(app.config["DATABASE"])
+        build(conn, args.messages, args.text_chars)
+        fields = tuple(f for f in MESSAGE_FIELDS if f == "id" or f in args.fields.split(","))
+
+        def row_dicts():
+            # The previous implementation: sqlite3.Row per row, then a dict.
+            rows = conn.execute(
+                "SELECT id, conversation_id, role, text, audio_filename, audio_segments, tts_status, created_at"
+                " FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                ("bench", args.messages),
+            ).fetchall()
+            rows.reverse()
+            return [_message_dict(r) for r in rows]
+
+        variants = [
+            ("Row dicts + flask json", DefaultJSONProvider, row_dicts, False),
+            ("tuples + compact json", CompactJSONProvider, None, False),
+        ]
+        if orjson is not None:
+            variants.append(("tuples + orjson", OrjsonProvider, None, False))
+        provider = OrjsonProvider if orjson is not None else CompactJSONProvider
+        variants += [
+            ("tuples + best + fields", provider, fields, False),
+            ("tuples + best + gzip", provider, None, True),
+            ("tuples + best + fields + gzip", provider, fields, True),
+        ]
+
+        print(f"{args.messages} messages of {args.text_chars} chars, median of {args.repeat} runs")
+        baseline = None
+        with app.app_context():
+            for label, provider_class, source, compress in variants:
+                app.json = provider_class(app)
+                if callable(source):
+                    load = source
+                else:
+                    def load(f=source or MESSAGE_FIELDS):
+                        return _page_messages(conn, "bench", limit=args.messages, fields=f)
+                samples = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    body = app.json.response(load()).get_data()
+                    if compress:
+                        body = gzip.compress(body, COMPRESS_LEVEL, mtime=0)
+                    samples.append((time.perf_counter() - start) * 1000)
+                ms = statistics.median(samples)
+                baseline = baseline or (ms, len(body))
+                print(f"{label:32} {ms:7.3f} ms ({ms / baseline[0]:5.2f}x)  "
+                      f"{len(body):8d} bytes ({len(body) / baseline[1]:5.2f}x)")
+        storage.pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""Load-test the app against local stand-ins for n8n and ElevenLabs.
+
+    python -m benchmarks.load --output results.json
+    python -m benchmarks.load --rows 10000 --output quick.json --baseline results.json
+
+Starts a StubWebhook in this process and the app (benchmarks.serve, with
+FakeTTSClient) in a subprocess on a temporary database, then runs these
+scenarios with --concurrency client threads:
+
+  messages  GET /api/messages on conversations seeded with each of --rows
+            messages: the newest page, a random cursor page, and a
+            conditional GET answered 304
+  upload    POST /api/upload_audio at each of --upload-sizes
+  e2e       one upload per trial, timing how long until the bot reply shows
+            up on the conversation's stream, until its first audio (a
+            sentence segment of a long reply) is playable, and until all
+            of its audio is ready
+
+Every scenario reports p50/p95/p99/mean/max latency in ms, throughput and
+errors. Results go to --output as JSON; --baseline prints how p50/p95
+moved against an earlier results file.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+import storage
+from benchmarks.stubs import StubWebhook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INSERT = "INSERT INTO messages (conversation_id, role, text, created_at) VALUES (?, ?, ?, ?)"
+
+
+def _sizes(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def summarize(samples, elapsed, errors):
+    samples = sorted(samples)
+
+    def pct(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p / 100))], 3) if samples else None
+
+    return {
+        "requests": len(samples) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": pct(50), "p95": pct(95), "p99": pct(99),
+            "mean": round(sum(samples) / len(samples), 3) if samples else None,
+            "max": pct(100),
+        },
+    }
+
+
+class Client:
+    """Runs timed requests from a pool of threads, one Session each."""
+
+    def __init__(self, base_url, concurrency):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def run(self, count, request, prepare=None, expect=(200,)):
+        # request(session, prepared) returns a response; prepare(i) builds
+        # its input outside the timed section.
+        lock = threading.Lock()
+        samples, errors = [], [0]
+
+        def one(i):
+            arg = prepare(i) if prepare else i
+            start = time.perf_counter()
+            try:
+                ok = request(self.session, arg).status_code in expect
+            except requests.RequestException:
+                ok = False
+            took = (time.perf_counter() - start) * 1000
+            with lock:
+                if ok:
+                    samples.append(took)
+                else:
+                    errors[0] += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            list(pool.map(one, range(count)))
+        return summarize(samples, time.perf_counter() - start, errors[0])
+
+
+def seed(path, rows, batch=10000):
+    # One conversation per size, "bench-<size>", written before the server
+    # starts so seeding doesn't hold the write lock against its job workers.
+    # Returns each conversation's (min id, max id).
+    conn = storage.connect(path)
+    storage.migrate(conn)
+    now = datetime.utcnow().isoformat()
+    ranges = {}
+    for size in rows:
+        started = time.perf_counter()
+        cid = f"bench-{size}"
+        for done in range(0, size, batch):
+            conn.executemany(INSERT, (
+                (cid, "user" if i % 2 else "bot", f"benchmark message {i}", now)
+                for i in range(done, min(size, done + batch))
+            ))
+            conn.commit()
+        ranges[size] = conn.execute(
+            "SELECT MIN(id), MAX(id) FROM messages WHERE conversation_id = ?", (cid,)
+        ).fetchone()
+        print(f"seeded {size} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    conn.close()
+    return ranges
+
+
+def bench_messages(client, ranges, count):
+    results = {}
+    for size, (min_id, max_id) in ranges.items():
+        url = f"{client.base_url}/api/messages?conversation_id=bench-{size}"
+        etag = requests.get(url + "&limit=100").headers["ETag"]
+        results[f"messages.newest@{size}"] = client.run(count, lambda s, _: s.get(url + "&limit=100"))
+        results[f"messages.page@{size}"] = client.run(
+            count, lambda s, before: s.get(f"{url}&limit=100&before_id={before}"),
+            prepare=lambda _: random.randint(min_id, max_id),
+        )
+        results[f"messages.not_modified@{size}"] = client.run(
+            count, lambda s, _: s.get(url + "&limit=100", headers={"If-None-Match": etag}), expect=(304,),
+        )
+    return results
+
+
+def bench_upload(client, sizes, count):
+    results = {}
+    url = f"{client.base_url}/api/upload_audio"
+    for size in sizes:
+        block = os.urandom(size)
+
+        def prepare(i):
+            # Distinct bytes per request, so blob dedup doesn't skip the write.
+            return i.to_bytes(8, "big") + block[8:]
+
+        results[f"upload@{size}"] = client.run(count, lambda s, body: s.post(url, files={
+            "audio": ("bench.webm", body, "audio/webm"),
+        }, data={"transcript": "benchmark upload", "conversation_id": "bench-upload"}), prepare=prepare)
+    return results
+
+
+def wait_for_jobs(base_url, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = requests.get(f"{base_url}/api/jobs/stats").json()
+        if not stats["pending"] and not stats["running"]:
+            return
+        time.sleep(0.5)
+    print("job queue still busy, continuing anyway", file=sys.stderr)
+
+
+def bench_e2e(client, trials, size, timeout=60):
+    # Listens on the trial's own conversation stream, uploads, and times the
+    # bot reply's insert event and the update that carries its audio.
+    run = f"{int(time.time())}"
+    marks = {"upload": [], "reply_visible": [], "first_audio": [], "audio_ready": []}
+    lock = threading.Lock()
+    errors = [0]
+    body = os.urandom(size)
+
+    def trial(i):
+        cid = f"e2e-{run}-{i}"
+        session = requests.Session()
+        got = {}
+        try:
+            with session.get(f"{client.base_url}/api/messages/stream?conversation_id={cid}",
+                             stream=True, timeout=(5, timeout)) as stream:
+                lines = stream.iter_lines(decode_unicode=True)
+                next(lines)  # "retry:" - subscribed from here on
+                start = time.perf_counter()
+                resp = session.post(f"{client.base_url}/api/upload_audio", files={
+                    "audio": ("e2e.webm", i.to_bytes(8, "big") + body[8:], "audio/webm"),
+                }, data={"transcript": "benchmark e2e", "conversation_id": cid})
+                got["upload"] = time.perf_counter() - start
+                if resp.status_code != 200:
+                    raise RuntimeError(f"upload returned {resp.status_code}")
+                event = None
+                for line in lines:
+                    if line.startswith("event: "):
+                        event = line[7:]
+                    elif line.startswith("data: ") and event in ("insert", "update"):
+                        msg = json.loads(line[6:])
+                        if msg["role"] != "bot":
+                            continue
+                        got.setdefault("reply_visible", time.perf_counter() - start)
+                        if msg.get("audio_segments") or msg["audio_filename"]:
+                            got.setdefault("first_audio", time.perf_counter() - start)
+                        if msg["tts_status"] == "ready" or (msg["audio_filename"] and not msg["tts_status"]):
+                            got["audio_ready"] = time.perf_counter() - start
+                            break
+        except (requests.RequestException, RuntimeError, StopIteration):
+            pass
+        finally:
+            session.close()
+        with lock:
+            if "audio_ready" not in got:
+                errors[0] += 1
+                return
+            for name, value in got.items():
+                marks[name].append(value * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(client.concurrency) as pool:
+        list(pool.map(trial, range(trials)))
+    elapsed = time.perf_counter() - start
+    return {f"e2e.{name}": summarize(samples, elapsed, errors[0]) for name, samples in marks.items()}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(directory, webhook_url, args):
+    port = _free_port()
+    env = dict(os.environ, WEBHOOK_URL=webhook_url, TTS_CACHE_DIR=os.path.join(directory, "tts_cache"),
+               GC_INTERVAL="0", JOB_QUEUE_MAX="1000000")
+    proc = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.serve", "--port", str(port),
+        "--database", os.path.join(directory, "chat.db"), "--uploads", os.path.join(directory, "uploads"),
+        "--tts-delay", str(args.tts_delay), "--tts-size", str(args.tts_size),
+        "--tts-per-char", str(args.tts_per_char),
+    ], cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            requests.get(f"{base_url}/api/jobs/stats", timeout=1)
+            return proc, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("server did not start within 30s")
+
+
+def compare(baseline, results):
+    for name, new in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        changes = []
+        for p in ("p50", "p95"):
+            a, b = old["latency_ms"][p], new["latency_ms"][p]
+            if a and b is not None:
+                changes.append(f"{p} {a:.1f} -> {b:.1f} ms ({(b - a) / a:+.0%})")
+        print(f"{name:36} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default="messages,upload,e2e")
+    parser.add_argument("--rows", type=_sizes, default=[10000, 100000, 1000000],
+                        help="comma-separated conversation sizes for the messages scenario")
+    parser.add_argument("--upload-sizes", type=_sizes, default=[16 * 1024, 256 * 1024, 4 * 1024 * 1024])
+    parser.add_argument("--requests", type=int, default=500, help="requests per messages scenario")
+    parser.add_argument("--upload-requests", type=int, default=100, help="requests per upload size")
+    parser.add_argument("--e2e-trials", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--webhook-latency", default="0.2", help="comma-separated seconds, used in turn")
+    parser.add_argument("--tts-delay", type=float, default=0.3)
+    parser.add_argument("--tts-size", type=int, default=32 * 1024)
+    parser.add_argument("--tts-per-char", type=float, default=0.0,
+                        help="extra fake synthesis seconds per character of reply")
+    parser.add_argument("--webhook-reply", default="Stub reply {n}",
+                        help="reply text the stub sends; {n} is the request number")
+    parser.add_argument("--output", help="write the results here as JSON (default: stdout)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(",")
+    started_at = datetime.utcnow().isoformat()
+
+    stub = StubWebhook(latencies=[float(x) for x in args.webhook_latency.split(",")], reply=args.webhook_reply).start()
+    results = {}
+    with tempfile.TemporaryDirectory() as d:
+        ranges = seed(os.path.join(d, "chat.db"), args.rows if "messages" in scenarios else [])
+        proc, base_url = start_server(d, stub.url, args)
+        client = Client(base_url, args.concurrency)
+        try:
+            if "messages" in scenarios:
+                results.update(bench_messages(client, ranges, args.requests))
+            if "upload" in scenarios:
+                results.update(bench_upload(client, args.upload_sizes, args.upload_requests))
+                wait_for_jobs(base_url)
+            if "e2e" in scenarios:
+                results.update(bench_e2e(client, args.e2e_trials, args.upload_sizes[0]))
+        finally:
+            proc.terminate()
+            proc.wait()
+            stub.stop()
+
+    report = {
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Measure full-text index backfill time and search latency.
+
+    python -m benchmarks.search --rows 1000000 --conversations 100
+
+Builds a database with --rows synthetic messages at schema version 6 (before
+the full-text index existed), times the migration that indexes them, then
+runs each query shape --queries times through search.search_messages() and
+reports latency percentiles. Words are drawn from a Zipf-like vocabulary so
+there are both very common and rare terms.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+import search
+import storage
+
+INSERT = "INSERT INTO messages (conversation_id, role, text, created_at) VALUES (?, ?, ?, ?)"
+QUERIES = {
+    "common word": "w0",
+    "rare word": "w4000",
+    "two words": "w1 w25",
+    "prefix": "w12*",
+    "phrase": '"w0 w1"',
+}
+
+
+def _vocabulary(size):
+    words = [f"w{i}" for i in range(size)]
+    weights = [1 / (i + 1) for i in range(size)]
+    return words, weights
+
+
+def build(path, rows, conversations, vocab_size, batch=10000):
+    conn = storage.connect(path)
+    storage.migrate(conn, storage.MIGRATIONS[:6])
+    words, weights = _vocabulary(vocab_size)
+    now = datetime.utcnow().isoformat()
+    done = 0
+    while done < rows:
+        n = min(batch, rows - done)
+        tokens = random.choices(words, weights, k=n * 12)
+        conn.executemany(INSERT, (
+            (f"c{random.randrange(conversations)}", random.choice(("user", "bot")),
+             " ".join(tokens[i * 12:i * 12 + random.randint(4, 12)]), now)
+            for i in range(n)
+        ))
+        conn.commit()
+        done += n
+    return conn
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200, help="runs per query shape")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "search.db")
+        start = time.perf_counter()
+        conn = build(path, args.rows, args.conversations, args.vocabulary)
+        print(f"built {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        storage.migrate(conn)
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        conn.commit()
+        print(f"backfill (migration 7 + optimize): {time.perf_counter() - start:.1f}s, "
+              f"database {os.path.getsize(path) / 2**20:.0f} MiB")
+
+        for label, q in QUERIES.items():
+            match = search.fts_query(q)
+            samples = []
+            for _ in range(args.queries):
+                cid = f"c{random.randrange(args.conversations)}"
+                start = time.perf_counter()
+                search.search_messages(conn, cid, match, args.limit)
+                samples.append((time.perf_counter() - start) * 1000)
+            print(f"{label:12} p50 {percentile(samples, 50):8.2f} ms  p95 {percentile(samples, 95):8.2f} ms  "
+                  f"mean {statistics.fmean(samples):8.2f} ms")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
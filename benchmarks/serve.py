@@ -0,0 +1,50 @@
+"""Run the app against a given database with the fake TTS client.
+
+    WEBHOOK_URL=http://127.0.0.1:8765/webhook \\
+        python -m benchmarks.serve --port 5001 --database /tmp/bench/chat.db --uploads /tmp/bench/uploads
+
+Started by benchmarks.load in its own process, so the load generator's
+threads don't compete with the server for the GIL. Uses werkzeug's
+threaded server with the background services running, like `python app.py`
+without the debug reloader.
+"""
+import argparse
+import logging
+
+from werkzeug.serving import make_server
+
+from benchmarks.stubs import FakeTTSClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--uploads", required=True)
+    parser.add_argument("--tts-delay", type=float, default=0.3, help="seconds per fake synthesis")
+    parser.add_argument("--tts-size", type=int, default=32 * 1024, help="bytes of fake audio")
+    parser.add_argument("--tts-per-char", type=float, default=0.0, help="extra seconds per character")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    from app import create_app, start_background
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app = create_app({
+        "DATABASE": args.database,
+        "UPLOAD_FOLDER": args.uploads,
+        "TTS_CLIENT": FakeTTSClient(args.tts_delay, args.tts_size, args.tts_per_char),
+        # The load generator is a single client; measure the app, not its
+        # per-client rate limits.
+        "UPLOAD_RATE": 0,
+        "WEBHOOK_RECEIVE_RATE": 0,
+    })
+    start_background(app)
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Local stand-ins for n8n and ElevenLabs, for benchmarks and manual testing.
+
+    python -m benchmarks.stubs --port 8765 --latency 0.2,0.5,1.0
+    WEBHOOK_URL=http://127.0.0.1:8765/webhook python app.py
+
+StubWebhook answers every POST like the n8n workflow does, after a
+latency taken in turn from the configured list. FakeTTSClient has the
+part of the ElevenLabs client TTSService uses and returns fixed-size audio
+after a delay.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubWebhook:
+    """HTTP server that replays configurable webhook latencies and replies.
+
+    `reply` is formatted with the request number `n`, so every reply is a
+    new text (and a TTS cache miss) unless it has no `{n}`. A `reply` of
+    None answers with an empty body, which stores no bot message.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latencies=(0.0,), reply="Stub reply {n}", status=200):
+        self.latencies = itertools.cycle(latencies)
+        self.reply = reply
+        self.status = status
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub._lock:
+                    stub.requests += 1
+                    stub.bytes_received += len(body)
+                    n = stub.requests
+                    delay = next(stub.latencies)
+                time.sleep(delay)
+                payload = b"" if stub.reply is None else json.dumps({"text": stub.reply.format(n=n)}).encode()
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/webhook"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-webhook", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeTTSClient:
+    """Drop-in for the ElevenLabs client as used by tts.TTSService.
+
+    `convert` sleeps `delay` seconds plus `per_char` per character of text
+    (synthesis time grows with length) and returns `size` bytes derived
+    from the text, so different texts give different audio.
+    """
+
+    def __init__(self, delay=0.3, size=32 * 1024, per_char=0.0):
+        self.delay = delay
+        self.size = size
+        self.per_char = per_char
+        self.calls = 0
+        self.text_to_speech = self
+
+    def convert(self, text, voice_id, model_id, output_format):
+        self.calls += 1
+        time.sleep(self.delay + self.per_char * len(text))
+        seed = hashlib.sha256(text.encode("utf-8")).digest()
+        return (seed * (self.size // len(seed) + 1))[:self.size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="0", help="comma-separated seconds, used in turn")
+    parser.add_argument("--reply", default="Stub reply {n}", help="reply text; {n} is the request number")
+    parser.add_argument("--status", type=int, default=200)
+    args = parser.parse_args()
+
+    latencies = [float(x) for x in args.latency.split(",")]
+    stub = StubWebhook(args.host, args.port, latencies, args.reply, args.status)
+    print(f"Stub webhook listening on {stub.url}")
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
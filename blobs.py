@@ -0,0 +1,99 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+
+
+# Stored audio is named after the SHA-256 of its bytes, so identical
+# recordings and repeated TTS replies share one file. The blobs table counts
+# the messages referencing each name (kept by triggers, storage migration 5).
+# Files are linked in and unlinked inside the write transaction that adds or
+# drops the reference; SQLite has one writer at a time, so re-adding a blob
+# can't interleave with deleting it.
+CHUNK_SIZE = 1024 * 1024
+CONTENT_NAME = re.compile(r"[0-9a-f]{64}\.[a-z0-9]{1,10}")
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+def file_digest(path):
+    h = new_hasher()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def content_name(digest, ext):
+    return f"{digest}{ext.lower()}"
+
+
+def is_content_name(name):
+    return CONTENT_NAME.fullmatch(name) is not None
+
+
+def blob_path(directory, name):
+    # Content-named blobs live two shard levels down (ab/cd/abcd...) so no
+    # directory grows too large; any other name is a legacy flat file.
+    if is_content_name(name):
+        return os.path.join(directory, name[:2], name[2:4], name)
+    return os.path.join(directory, name)
+
+
+def locate(directory, name):
+    """Return the path of the existing file for `name`, or None.
+
+    Also finds content-named blobs stored flat before the sharded layout.
+    Names that would reach outside `directory` or into hidden entries are
+    never resolved.
+    """
+    if os.path.basename(name) != name or name.startswith("."):
+        return None
+    paths = [blob_path(directory, name)]
+    if is_content_name(name):
+        paths.append(os.path.join(directory, name))
+    for path in paths:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def adopt(src, directory, name):
+    """Make `src` available as blob `name` unless that blob already exists.
+
+    `src` is left in place for the caller to remove. Returns True when a new
+    file was created.
+    """
+    if locate(directory, name) is not None:
+        return False
+    dest = blob_path(directory, name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        return False
+    except OSError:
+        tmp = os.path.join(os.path.dirname(dest), f".blob-{uuid.uuid4().hex}")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    return True
+
+
+def release(conn, directory, name):
+    """Drop blob `name` if no message references it any more.
+
+    Call inside the transaction that removed the reference. Returns the
+    number of bytes freed.
+    """
+    cur = conn.execute("DELETE FROM blobs WHERE name = ? AND refcount <= 0", (name,))
+    if not cur.rowcount:
+        return 0
+    path = locate(directory, name)
+    if path is None:
+        return 0
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
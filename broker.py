@@ -0,0 +1,196 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+
+class MessageBroker:
+    """Fans committed message events out to stream listeners, per topic.
+
+    Topics are conversations. Each topic with at least one subscriber has
+    its own bounded ring buffer and condition; every subscriber keeps its
+    own position in it and sleeps until something newer arrives. Publishing
+    is O(1) regardless of how many listeners there are, only wakes the
+    topic's own subscribers, and is a no-op for topics nobody is watching,
+    so a conversation's stream cost doesn't grow with activity elsewhere.
+    Listeners never touch the database while they wait.
+    """
+
+    def __init__(self, backlog=1000):
+        self.backlog = backlog
+        self._lock = threading.Lock()
+        self._topics = {}
+
+    @property
+    def listeners(self):
+        with self._lock:
+            return sum(t.subscribers for t in self._topics.values())
+
+    @property
+    def topics(self):
+        with self._lock:
+            return len(self._topics)
+
+    def publish(self, kind, data, topic=None):
+        with self._lock:
+            t = self._topics.get(topic)
+        if t is not None:
+            t.publish(kind, data)
+
+    def subscribe(self, topic=None):
+        """Start receiving events published to `topic` from now on.
+
+        Close the returned subscription (or use it as a context manager)
+        when done; a topic's buffer is dropped with its last subscriber.
+        """
+        with self._lock:
+            t = self._topics.get(topic)
+            if t is None:
+                t = self._topics[topic] = _Topic(self.backlog)
+            t.subscribers += 1
+        return Subscription(self, topic, t)
+
+    def _unsubscribe(self, topic, t):
+        with self._lock:
+            t.subscribers -= 1
+            if not t.subscribers and self._topics.get(topic) is t:
+                del self._topics[topic]
+
+
+class _Topic:
+    def __init__(self, backlog):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=backlog)
+        self.seq = 0
+        self.subscribers = 0
+
+    def publish(self, kind, data):
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, kind, data))
+            self.cond.notify_all()
+
+
+class Subscription:
+    def __init__(self, broker, topic, t):
+        self._broker = broker
+        self._topic = topic
+        self._t = t
+        with t.cond:
+            self.position = t.seq
+        self._closed = False
+
+    def wait(self, timeout=None):
+        """Block until there are new events or `timeout` passes.
+
+        Returns the events as `(seq, kind, data)` tuples: an empty list on
+        timeout and None when this subscriber fell so far behind that the
+        events it missed were already dropped from the ring buffer.
+        """
+        t = self._t
+        with t.cond:
+            if t.seq == self.position:
+                t.cond.wait(timeout)
+            if t.seq == self.position:
+                return []
+            oldest = t.events[0][0]
+            if self.position + 1 < oldest:
+                self.position = t.seq
+                return None
+            events = list(islice(t.events, self.position + 1 - oldest, None))
+            self.position = t.seq
+            return events
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._broker._unsubscribe(self._topic, self._t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EventRelay:
+    """Carries broker events between processes through the `events` table.
+
+    With several worker processes, a message written in one has to reach
+    stream listeners connected to another. Publishers append events to the
+    table (inside their own write, via `append`); every process runs one
+    relay thread that tails the table from where it started and republishes
+    new rows to its local broker. Old rows are pruned after `retention`
+    seconds. While a process has no listeners, the relay only advances its
+    position instead of reading the rows.
+    """
+
+    def __init__(self, broker, get_conn, poll_interval=0.1, retention=300.0):
+        self.broker = broker
+        self.get_conn = get_conn
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.position = None
+        self.relayed = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._next_prune = 0.0
+
+    @staticmethod
+    def append(conn, events):
+        """Add `(kind, data, topic)` events in the caller's transaction."""
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO events (topic, kind, data, created_at) VALUES (?, ?, ?, ?)",
+            [(topic, kind, json.dumps(data), now) for kind, data, topic in events],
+        )
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="event-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def poll(self, conn):
+        """Republish events newer than the current position; returns how many."""
+        if self.position is None:
+            self.position = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            return 0
+        if not self.broker.listeners:
+            latest = conn.execute("SELECT MAX(id) FROM events").fetchone()[0]
+            self.position = max(self.position, latest or 0)
+            return 0
+        rows = conn.execute(
+            "SELECT id, topic, kind, data FROM events WHERE id > ? ORDER BY id", (self.position,)
+        ).fetchall()
+        for row in rows:
+            self.broker.publish(row["kind"], json.loads(row["data"]), row["topic"])
+            self.position = row["id"]
+        self.relayed += len(rows)
+        return len(rows)
+
+    def prune(self, conn):
+        conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - self.retention,))
+        conn.commit()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                conn = self.get_conn()
+                self.poll(conn)
+                conn.commit()
+                if time.monotonic() >= self._next_prune:
+                    self._next_prune = time.monotonic() + 60
+                    self.prune(conn)
+            except Exception:
+                logging.exception("Event relay poll failed")
+            self._stop.wait(self.poll_interval)
@@ -0,0 +1,11 @@
+# gunicorn settings for wsgi.py; environment variables override the defaults.
+import os
+
+wsgi_app = "wsgi:application"
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+# Threads per worker: stream listeners and uploads hold one each while open.
+threads = int(os.getenv("THREADS", 16))
+# Each worker must import the app itself; see wsgi.py.
+preload_app = False
+timeout = 120
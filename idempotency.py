@@ -0,0 +1,67 @@
+import hashlib
+import json
+import time
+
+
+# A client (or a retried job) sends the same key with every delivery of one
+# logical write. The first delivery stores its response under the key in the
+# same transaction as the write; later ones get that response back instead
+# of writing again. The lookup runs after BEGIN IMMEDIATE, so concurrent
+# duplicates queue on SQLite's write lock and all but the first see the
+# stored response. Keys are forgotten after `ttl` seconds, and at most
+# `max_keys` are kept.
+MAX_KEY_LENGTH = 255
+
+
+class Replayed(Exception):
+    """Raised inside a write when its key was already used; carries the
+    response stored by the first delivery."""
+
+    def __init__(self, response):
+        super().__init__("idempotency key already used")
+        self.response = response
+
+
+class KeyReused(Exception):
+    """Raised when a key comes back with a different request body."""
+
+
+def fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def check(conn, key, ttl, request_fingerprint=None):
+    """Raise Replayed (or KeyReused) if `key` was used in the last `ttl` seconds.
+
+    Call in the write transaction, after taking the write lock.
+    """
+    row = conn.execute(
+        "SELECT fingerprint, response FROM idempotency_keys WHERE key = ? AND created_at > ?",
+        (key, time.time() - ttl),
+    ).fetchone()
+    if row is None:
+        return
+    if request_fingerprint is not None and row["fingerprint"] not in (None, request_fingerprint):
+        raise KeyReused(f"idempotency key {key!r} was used with a different request")
+    raise Replayed(json.loads(row["response"]))
+
+
+def remember(conn, key, response, ttl, max_keys, request_fingerprint=None):
+    """Store `response` under `key` and drop expired and surplus keys."""
+    now = time.time()
+    conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?", (now - ttl,))
+    conn.execute(
+        "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, response, created_at) VALUES (?, ?, ?, ?)",
+        (key, request_fingerprint, json.dumps(response), now),
+    )
+    conn.execute(
+        "DELETE FROM idempotency_keys WHERE rowid <= (SELECT MAX(rowid) FROM idempotency_keys) - ?", (max_keys,),
+    )
+
+
+def seen(conn, key, ttl):
+    """Whether `key` has a stored response; for skipping work before a write."""
+    row = conn.execute(
+        "SELECT 1 FROM idempotency_keys WHERE key = ? AND created_at > ?", (key, time.time() - ttl),
+    ).fetchone()
+    return row is not None
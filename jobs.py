@@ -0,0 +1,251 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+
+Job = namedtuple("Job", "id kind payload attempts")
+
+
+class QueueFull(Exception):
+    """Raised by `enqueue` when the queue already holds `max_pending` jobs."""
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying the job cannot succeed."""
+
+
+class RetryLater(Exception):
+    """Raised by a handler to put the job back for `delay` seconds.
+
+    Unlike other errors this doesn't use up one of the job's attempts; it is
+    meant for waiting out a dependency that is known to be unavailable.
+    """
+
+    def __init__(self, delay, message=None):
+        super().__init__(message or f"retry in {delay:.0f}s")
+        self.delay = delay
+
+
+class JobQueue:
+    """Durable job queue stored in SQLite and served by a fixed worker pool.
+
+    Jobs move pending -> running and are deleted when their handler returns.
+    A handler that raises is retried with exponential backoff (with jitter)
+    until `max_attempts`, after which the job is parked as `dead` for
+    inspection; raising RetryLater reschedules it without counting an
+    attempt. `on_finish(kind, outcome, seconds)`, if given, is called after
+    every run with outcome done, deferred, retry or dead.
+
+    Several processes can serve the same queue. A claimed job is leased for
+    `lease` seconds and the lease is renewed while it runs; a job whose
+    lease ran out (its process died) is claimed again by any worker. A run
+    only records its result if the job wasn't reclaimed in the meantime.
+    """
+
+    def __init__(self, get_conn, workers=4, max_pending=500, max_attempts=5,
+                 backoff_base=2.0, backoff_max=300.0, poll_interval=1.0, lease=30.0, on_finish=None):
+        self.get_conn = get_conn
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.on_finish = on_finish
+        self._handlers = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._busy = 0
+        self._running = set()
+
+    @property
+    def busy(self):
+        return self._busy
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping = False
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._renew_leases, name="job-leases", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def enqueue(self, kind, payload, conn):
+        """Insert a job inside the caller's open transaction on `conn`.
+
+        The job becomes visible when the caller commits; call `wake()` after
+        committing so an idle worker picks it up immediately. Raises
+        QueueFull when the queue has no room.
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"no handler registered for job kind {kind!r}")
+        depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+        if depth >= self.max_pending:
+            raise QueueFull(f"{depth} jobs already queued")
+        now = datetime.utcnow().isoformat()
+        cur = conn.execute(
+            "INSERT INTO jobs (kind, payload, run_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload), time.time(), now, now),
+        )
+        return cur.lastrowid
+
+    def full(self, conn):
+        depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+        return depth >= self.max_pending
+
+    def stats(self, conn):
+        counts = {"pending": 0, "running": 0, "dead": 0}
+        for row in conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[row[0]] = row[1]
+        counts["workers"] = len(self._threads)
+        counts["busy_workers"] = self._busy
+        counts["max_pending"] = self.max_pending
+        return counts
+
+    def _claim(self, conn):
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs"
+                " WHERE status = 'pending' AND run_at <= ? ORDER BY run_at, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                # Left running by a process that stopped renewing its lease;
+                # rows from before leases existed have none.
+                row = conn.execute(
+                    "SELECT id, kind, payload, attempts FROM jobs"
+                    " WHERE status = 'running' AND (lease_until IS NULL OR lease_until <= ?) ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    logging.info(f"Replaying interrupted job {row['id']} ({row['kind']})")
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?"
+                " WHERE id = ?",
+                (now + self.lease, datetime.utcnow().isoformat(), row["id"]),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return Job(row["id"], row["kind"], json.loads(row["payload"]), row["attempts"] + 1)
+
+    def _work(self):
+        while not self._stopping:
+            conn = self.get_conn()
+            try:
+                job = self._claim(conn)
+            except sqlite3.OperationalError:
+                logging.exception("Failed to claim job")
+                job = None
+            if job is None:
+                with self._cond:
+                    if not self._stopping:
+                        self._cond.wait(self.poll_interval)
+                continue
+            with self._cond:
+                self._busy += 1
+                self._running.add(job.id)
+            try:
+                self._run(conn, job)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._running.discard(job.id)
+
+    def _renew_leases(self):
+        while True:
+            with self._cond:
+                if not self._stopping:
+                    self._cond.wait(self.lease / 3)
+                if self._stopping:
+                    return
+                ids = list(self._running)
+            if not ids:
+                continue
+            conn = self.get_conn()
+            try:
+                conn.execute(
+                    f"UPDATE jobs SET lease_until = ? WHERE status = 'running'"
+                    f" AND id IN ({', '.join('?' * len(ids))})",
+                    [time.time() + self.lease, *ids],
+                )
+                conn.commit()
+            except sqlite3.OperationalError:
+                conn.rollback()
+                logging.exception("Failed to renew job leases")
+
+    def _run(self, conn, job):
+        started = time.perf_counter()
+        outcome = self._execute(conn, job)
+        if self.on_finish is not None:
+            self.on_finish(job.kind, outcome, time.perf_counter() - started)
+
+    def _execute(self, conn, job):
+        now = datetime.utcnow().isoformat()
+        try:
+            self._handlers[job.kind](job)
+        except RetryLater as e:
+            logging.info(f"Job {job.id} ({job.kind}) deferred for {e.delay:.0f}s: {e}")
+            self._finish(conn, job, "UPDATE jobs SET status = 'pending', attempts = attempts - 1, run_at = ?,"
+                                    " last_error = ?, updated_at = ?",
+                         (time.time() + e.delay, f"{type(e).__name__}: {e}", now))
+            return "deferred"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if isinstance(e, PermanentJobError) or job.attempts >= self.max_attempts:
+                logging.exception(f"Job {job.id} ({job.kind}) failed permanently after {job.attempts} attempt(s)")
+                self._finish(conn, job, "UPDATE jobs SET status = 'dead', last_error = ?, updated_at = ?",
+                             (error, now))
+                return "dead"
+            delay = min(self.backoff_max, self.backoff_base ** job.attempts) * random.uniform(0.5, 1.0)
+            logging.warning(f"Job {job.id} ({job.kind}) failed, retrying in {delay:.1f}s: {error}")
+            self._finish(conn, job, "UPDATE jobs SET status = 'pending', run_at = ?, last_error = ?, updated_at = ?",
+                         (time.time() + delay, error, now))
+            return "retry"
+        self._finish(conn, job, "DELETE FROM jobs", ())
+        return "done"
+
+    def _finish(self, conn, job, sql, params):
+        # A handler may have left its own transaction open on the shared
+        # per-thread connection; don't commit its half-done work with ours.
+        if conn.in_transaction:
+            conn.rollback()
+        # Each claim bumps attempts, so a changed count means the lease ran
+        # out and another worker owns the job now.
+        cur = conn.execute(f"{sql} WHERE id = ? AND attempts = ? AND status = 'running'",
+                           (*params, job.id, job.attempts))
+        conn.commit()
+        if not cur.rowcount:
+            logging.warning(f"Job {job.id} ({job.kind}) was reclaimed by another worker; dropping this result")
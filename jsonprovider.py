@@ -0,0 +1,62 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: the standard library encoder is used instead
+    orjson = None
+
+
+class CompactJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, minus the work responses don't need.
+
+    Keys aren't sorted, separators carry no spaces (also in debug mode) and
+    non-ASCII text is written as UTF-8 instead of \\u escapes, which keeps
+    transcripts in other scripts at about half the size.
+    """
+
+    sort_keys = False
+    ensure_ascii = False
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault("separators", (",", ":"))
+        return super().dumps(obj, **kwargs)
+
+
+class OrjsonProvider(CompactJSONProvider):
+    """JSON through orjson, several times faster than the json module.
+
+    Responses are encoded straight to bytes. Calls with json-module keyword
+    arguments fall back to the standard library.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_APPEND_NEWLINE), mimetype=self.mimetype,
+        )
+
+
+PROVIDERS = {"flask": DefaultJSONProvider, "stdlib": CompactJSONProvider, "orjson": OrjsonProvider}
+
+
+def provider_for(name):
+    """Provider class for `name`; "auto" is orjson when installed, else stdlib."""
+    if name == "auto":
+        name = "stdlib" if orjson is None else "orjson"
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("JSON_PROVIDER=orjson needs the orjson package")
+    try:
+        return PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"unknown JSON_PROVIDER {name!r}, expected auto or one of {', '.join(PROVIDERS)}")
@@ -0,0 +1,171 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """Raised when a concurrency budget has no free slot."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} concurrency budget exhausted, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Per-client token buckets.
+
+    Each client key gets a bucket of `burst` tokens, refilled at `rate`
+    tokens per second; every request takes one. Buckets are kept in memory
+    for the `max_keys` most recently seen clients, so each process enforces
+    its own limit. A `rate` of 0 admits everything. `on_admission(admitted)`
+    is called for every request, e.g. to count it in metrics.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000, on_admission=None):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.on_admission = on_admission
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self, key):
+        """Take a token for `key`.
+
+        Returns 0 when the request is admitted, otherwise the seconds until
+        the client's next token.
+        """
+        if not self.rate:
+            with self._lock:
+                self.admitted += 1
+            wait = 0
+        else:
+            wait = self._take(key)
+        if self.on_admission is not None:
+            self.on_admission(not wait)
+        return wait
+
+    def _take(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.admitted += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.shed += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "clients": len(self._buckets),
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
+
+
+class Budget:
+    """Cap on concurrent calls to one upstream, shared by all processes.
+
+    A call holds one of `limit` slots, rows in the `leases` table named
+    `<name>:<n>`, for as long as it runs. When all are held, `slot()` polls
+    for up to `wait` seconds (by default not at all), then raises
+    Overloaded and the caller sheds the work.
+    A slot left behind by a crashed process frees itself after `ttl`
+    seconds, so `ttl` must outlast the longest call. A `limit` of 0 means
+    unlimited. `on_admission(admitted)` is called for every call.
+    """
+
+    def __init__(self, get_conn, name, limit, ttl=600.0, retry_after=5.0, on_admission=None):
+        self.get_conn = get_conn
+        self.name = name
+        self.limit = limit
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.on_admission = on_admission
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.shed = 0
+
+    def _count(self, admitted):
+        with self._lock:
+            if admitted:
+                self.admitted += 1
+            else:
+                self.shed += 1
+        if self.on_admission is not None:
+            self.on_admission(admitted)
+
+    def _acquire(self, owner):
+        conn = self.get_conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            held = {row[0] for row in conn.execute(
+                "SELECT name FROM leases WHERE name >= ? AND name < ? AND expires_at > ?",
+                (f"{self.name}:", f"{self.name};", now),
+            )}
+            slot = next((s for s in (f"{self.name}:{n}" for n in range(self.limit)) if s not in held), None)
+            if slot is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                    (slot, owner, now + self.ttl),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return slot
+
+    def _release(self, slot, owner):
+        conn = self.get_conn()
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (slot, owner))
+        conn.commit()
+
+    @contextmanager
+    def slot(self, wait=0.0):
+        if not self.limit:
+            self._count(True)
+            yield
+            return
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        delay = 0.05
+        slot = self._acquire(owner)
+        while slot is None and time.monotonic() + delay <= deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            slot = self._acquire(owner)
+        self._count(slot is not None)
+        if slot is None:
+            raise Overloaded(self.name, self.retry_after)
+        try:
+            yield
+        finally:
+            self._release(slot, owner)
+
+    def in_use(self):
+        row = self.get_conn().execute(
+            "SELECT COUNT(*) FROM leases WHERE name >= ? AND name < ? AND expires_at > ?",
+            (f"{self.name}:", f"{self.name};", time.time()),
+        ).fetchone()
+        return row[0]
+
+    def stats(self):
+        with self._lock:
+            counts = {"admitted": self.admitted, "shed": self.shed}
+        return {"limit": self.limit, "in_use": self.in_use(), **counts}
@@ -0,0 +1,72 @@
+import base64
+import html
+import re
+
+# snippet() wraps matches in these private-use characters, which real text
+# doesn't contain; they become <mark> tags after the rest of the snippet
+# has been HTML-escaped.
+_OPEN, _CLOSE = "\ue000", "\ue001"
+SNIPPET_TOKENS = 12
+
+_TERM = re.compile(r'"[^"]*"|\S+')
+
+
+def fts_query(q):
+    """Turn a user's search box input into an FTS5 MATCH expression.
+
+    Each word or "quoted phrase" must match (implicit AND); a trailing `*`
+    makes a word a prefix search. Everything else is quoted, so FTS5
+    operators in the input are searched for literally rather than raising
+    syntax errors, and terms without any letters or digits are dropped.
+    Returns None when nothing searchable is left.
+    """
+    terms = []
+    for term in _TERM.findall(q or ""):
+        prefix = term.endswith("*") and not term.startswith('"')
+        term = term.strip('"').rstrip("*").replace('"', '""')
+        if any(ch.isalnum() for ch in term):
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+def encode_cursor(rank, msg_id):
+    return base64.urlsafe_b64encode(f"{rank!r}:{msg_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        rank, msg_id = raw.split(":")
+        return float(rank), int(msg_id)
+    except ValueError as e:
+        raise ValueError("invalid cursor") from e
+
+
+def highlight(snippet):
+    return html.escape(snippet or "").replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>")
+
+
+def search_messages(conn, conversation_id, match, limit, after=None, columns="m.*"):
+    """Best matches for `match` in one conversation, best (lowest bm25) first.
+
+    Ties are broken by id so (rank, id) is a stable keyset cursor: pass the
+    last row's pair as `after` to get the next page. Returns rows with the
+    requested message `columns` plus `rank` and the raw `snippet`.
+    """
+    # The indexed conversation_id column narrows the match before ranking;
+    # its tokens are looser than the id itself, so the join re-checks it.
+    if any(ch.isalnum() for ch in conversation_id):
+        scope = conversation_id.replace('"', '""')
+        match = f'conversation_id : "{scope}" AND ({match})'
+    sql = (
+        f"SELECT {columns}, messages_fts.rank AS rank, snippet(messages_fts, 0, ?, ?, '…', ?) AS snippet"
+        " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        " WHERE messages_fts MATCH ? AND m.conversation_id = ?"
+    )
+    params = [_OPEN, _CLOSE, SNIPPET_TOKENS, match, conversation_id]
+    if after is not None:
+        sql += " AND (messages_fts.rank > ? OR (messages_fts.rank = ? AND m.id > ?))"
+        params += [after[0], after[0], after[1]]
+    sql += " ORDER BY messages_fts.rank, m.id LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
@@ -0,0 +1,521 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Applied to every connection. WAL lets readers proceed while a writer
+# commits; synchronous=NORMAL is durable across application crashes in WAL
+# mode and only fsyncs at checkpoints.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -20000",  # KiB, i.e. ~20 MB of page cache
+    "PRAGMA mmap_size = 268435456",  # 256 MB
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+def connect(path, pragmas=PRAGMAS):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    for pragma in pragmas:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Hands each thread one long-lived connection per database file.
+
+    Request handlers and background workers both borrow from here instead of
+    opening and closing a connection around every statement. A connection
+    lives as long as its thread, so servers that reuse worker threads reuse
+    connections too.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        # {path: fn(conn)} run once on each new connection to that path,
+        # e.g. to ATTACH another database.
+        self.on_connect = {}
+
+    def get(self, path):
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(path)
+        if conn is None:
+            conn = connect(path)
+            setup = self.on_connect.get(path)
+            if setup is not None:
+                setup(conn)
+            conns[path] = conn
+        return conn
+
+    def release(self):
+        # Called at the end of a request/job: never keep a transaction open
+        # on a connection that stays in the pool.
+        for conn in getattr(self._local, "conns", {}).values():
+            if conn.in_transaction:
+                conn.rollback()
+
+    def close(self):
+        # Close the calling thread's connections, e.g. when a worker exits.
+        for conn in getattr(self._local, "conns", {}).values():
+            conn.close()
+        self._local.conns = {}
+
+
+pool = ConnectionPool()
+
+
+# Schema history. Each entry upgrades the database from version N-1 to N and
+# is applied at most once, tracked with PRAGMA user_version. Never edit an
+# entry that has shipped; append a new one.
+MIGRATIONS = [
+    # 1: baseline schema as created by earlier init_db() versions.
+    # message_stats is a single-row summary kept current by triggers, so
+    # conditional GETs can build validators without scanning messages.
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        role TEXT NOT NULL,
+        text TEXT,
+        audio_filename TEXT,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS message_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        row_count INTEGER NOT NULL,
+        max_id INTEGER NOT NULL,
+        changed_at TEXT NOT NULL
+    );
+    INSERT OR IGNORE INTO message_stats (id, row_count, max_id, changed_at)
+        SELECT 1, COUNT(*), COALESCE(MAX(id), 0), strftime('%Y-%m-%dT%H:%M:%f', 'now') FROM messages;
+    CREATE TRIGGER IF NOT EXISTS message_stats_insert AFTER INSERT ON messages BEGIN
+        UPDATE message_stats
+        SET row_count = row_count + 1,
+            max_id = MAX(max_id, NEW.id),
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS message_stats_delete AFTER DELETE ON messages BEGIN
+        UPDATE message_stats
+        SET row_count = row_count - 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+    END;
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        run_at REAL NOT NULL,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at);
+    """,
+    # 2: secondary indexes for time- and role-filtered reads
+    """
+    CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+    CREATE INDEX IF NOT EXISTS messages_role ON messages (role);
+    """,
+    # 3: tts_status for asynchronously synthesized audio, plus a change
+    # counter. Every insert/update stamps the row's rev with the next
+    # message_stats.version, so pollers can ask for "rows changed since rev N"
+    # and validators change on updates too.
+    """
+    ALTER TABLE messages ADD COLUMN tts_status TEXT;
+    ALTER TABLE messages ADD COLUMN rev INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE message_stats ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+    UPDATE message_stats SET version = max_id;
+    CREATE INDEX messages_rev ON messages (rev);
+    DROP TRIGGER message_stats_insert;
+    DROP TRIGGER message_stats_delete;
+    CREATE TRIGGER message_stats_insert AFTER INSERT ON messages BEGIN
+        UPDATE message_stats
+        SET row_count = row_count + 1,
+            max_id = MAX(max_id, NEW.id),
+            version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+        UPDATE messages SET rev = (SELECT version FROM message_stats WHERE id = 1) WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER message_stats_delete AFTER DELETE ON messages BEGIN
+        UPDATE message_stats
+        SET row_count = row_count - 1,
+            version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+    END;
+    CREATE TRIGGER message_stats_update AFTER UPDATE OF text, audio_filename, tts_status ON messages BEGIN
+        UPDATE message_stats
+        SET version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+        UPDATE messages SET rev = (SELECT version FROM message_stats WHERE id = 1) WHERE id = NEW.id;
+    END;
+    """,
+    # 4: resumable uploads. The bytes received so far live in a part file
+    # named after the session id; the row records what the finished upload
+    # needs and when the session was last touched, for expiry.
+    """
+    CREATE TABLE upload_sessions (
+        id TEXT PRIMARY KEY,
+        ext TEXT NOT NULL,
+        transcript TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE INDEX upload_sessions_updated_at ON upload_sessions (updated_at);
+    """,
+    # 5: reference counts for stored audio files (see blobs.py). Rows whose
+    # count drops to 0 are removed, with their file, by blobs.release().
+    """
+    CREATE TABLE blobs (
+        name TEXT PRIMARY KEY,
+        refcount INTEGER NOT NULL
+    );
+    INSERT INTO blobs (name, refcount)
+        SELECT audio_filename, COUNT(*) FROM messages WHERE audio_filename IS NOT NULL GROUP BY audio_filename;
+    CREATE TRIGGER blobs_ref_insert AFTER INSERT ON messages WHEN NEW.audio_filename IS NOT NULL BEGIN
+        INSERT INTO blobs (name, refcount) VALUES (NEW.audio_filename, 1)
+            ON CONFLICT (name) DO UPDATE SET refcount = refcount + 1;
+    END;
+    CREATE TRIGGER blobs_ref_delete AFTER DELETE ON messages WHEN OLD.audio_filename IS NOT NULL BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE name = OLD.audio_filename;
+    END;
+    CREATE TRIGGER blobs_ref_update AFTER UPDATE OF audio_filename ON messages
+    WHEN OLD.audio_filename IS NOT NEW.audio_filename BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE name = OLD.audio_filename;
+        INSERT INTO blobs (name, refcount) SELECT NEW.audio_filename, 1 WHERE NEW.audio_filename IS NOT NULL
+            ON CONFLICT (name) DO UPDATE SET refcount = refcount + 1;
+    END;
+    """,
+    # 6: conversations. Every message belongs to one; reads are scoped to a
+    # conversation through (conversation_id, id) and (conversation_id, rev),
+    # and conversation_stats is the per-conversation counterpart of
+    # message_stats. Its version is the global change counter as of the
+    # conversation's last change, so it orders with messages.rev. The
+    # message_stats triggers are recreated to maintain both, keeping one
+    # trigger per event so the order of the updates is fixed.
+    """
+    ALTER TABLE messages ADD COLUMN conversation_id TEXT NOT NULL DEFAULT 'default';
+    ALTER TABLE upload_sessions ADD COLUMN conversation_id TEXT NOT NULL DEFAULT 'default';
+    CREATE INDEX messages_conversation_id ON messages (conversation_id, id);
+    CREATE INDEX messages_conversation_rev ON messages (conversation_id, rev);
+    CREATE TABLE conversation_stats (
+        conversation_id TEXT PRIMARY KEY,
+        row_count INTEGER NOT NULL,
+        max_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        changed_at TEXT NOT NULL
+    );
+    INSERT INTO conversation_stats (conversation_id, row_count, max_id, version, changed_at)
+        SELECT conversation_id, COUNT(*), MAX(id), (SELECT version FROM message_stats WHERE id = 1),
+               (SELECT changed_at FROM message_stats WHERE id = 1)
+        FROM messages GROUP BY conversation_id;
+    DROP TRIGGER message_stats_insert;
+    DROP TRIGGER message_stats_delete;
+    DROP TRIGGER message_stats_update;
+    CREATE TRIGGER message_stats_insert AFTER INSERT ON messages BEGIN
+        UPDATE message_stats
+        SET row_count = row_count + 1,
+            max_id = MAX(max_id, NEW.id),
+            version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+        UPDATE messages SET rev = (SELECT version FROM message_stats WHERE id = 1) WHERE id = NEW.id;
+        INSERT INTO conversation_stats (conversation_id, row_count, max_id, version, changed_at)
+            SELECT NEW.conversation_id, 1, NEW.id, version, changed_at FROM message_stats WHERE id = 1
+            ON CONFLICT (conversation_id) DO UPDATE
+            SET row_count = row_count + 1,
+                max_id = MAX(max_id, excluded.max_id),
+                version = excluded.version,
+                changed_at = excluded.changed_at;
+    END;
+    CREATE TRIGGER message_stats_delete AFTER DELETE ON messages BEGIN
+        UPDATE message_stats
+        SET row_count = row_count - 1,
+            version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+        UPDATE conversation_stats
+        SET row_count = row_count - 1,
+            version = (SELECT version FROM message_stats WHERE id = 1),
+            changed_at = (SELECT changed_at FROM message_stats WHERE id = 1)
+        WHERE conversation_id = OLD.conversation_id;
+    END;
+    CREATE TRIGGER message_stats_update AFTER UPDATE OF text, audio_filename, tts_status ON messages BEGIN
+        UPDATE message_stats
+        SET version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+        UPDATE messages SET rev = (SELECT version FROM message_stats WHERE id = 1) WHERE id = NEW.id;
+        UPDATE conversation_stats
+        SET version = (SELECT version FROM message_stats WHERE id = 1),
+            changed_at = (SELECT changed_at FROM message_stats WHERE id = 1)
+        WHERE conversation_id = NEW.conversation_id;
+    END;
+    """,
+    # 7: full-text index over message text (see search.py). An external
+    # content table, so the text isn't stored twice; triggers keep it in
+    # step with every write path. conversation_id is indexed alongside so a
+    # search only ranks that conversation's matches, and weighted 0 in
+    # bm25. Existing rows are indexed here too; `flask --app app
+    # search-backfill` runs this ahead of a deploy.
+    """
+    CREATE VIRTUAL TABLE messages_fts USING fts5(
+        text, conversation_id, content = 'messages', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+    INSERT INTO messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)');
+    INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text, conversation_id) VALUES (NEW.id, NEW.text, NEW.conversation_id);
+    END;
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text, conversation_id)
+        VALUES ('delete', OLD.id, OLD.text, OLD.conversation_id);
+    END;
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF text, conversation_id ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text, conversation_id)
+        VALUES ('delete', OLD.id, OLD.text, OLD.conversation_id);
+        INSERT INTO messages_fts (rowid, text, conversation_id) VALUES (NEW.id, NEW.text, NEW.conversation_id);
+    END;
+    """,
+    # 8: running several worker processes. Jobs carry a lease so a job is
+    # only replayed once the process running it has stopped renewing it.
+    # `leases` elects one process for singleton work (the orphan sweeper).
+    # `events` carries stream notifications between processes (EVENT_LOG).
+    """
+    ALTER TABLE jobs ADD COLUMN lease_until REAL;
+    CREATE TABLE leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE TABLE events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT,
+        kind TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX events_created_at ON events (created_at);
+    """,
+    # 9: progressive speech. While a long reply is being synthesized
+    # sentence by sentence, audio_segments holds a JSON list of the blob
+    # names ready so far, in order. Segments aren't counted in `blobs`; the
+    # orphan sweeper removes them some time after the full audio is stored.
+    # The update trigger is recreated so segment progress bumps rev.
+    """
+    ALTER TABLE messages ADD COLUMN audio_segments TEXT;
+    DROP TRIGGER message_stats_update;
+    CREATE TRIGGER message_stats_update AFTER UPDATE OF text, audio_filename, tts_status, audio_segments ON messages
+    BEGIN
+        UPDATE message_stats
+        SET version = version + 1,
+            changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+        UPDATE messages SET rev = (SELECT version FROM message_stats WHERE id = 1) WHERE id = NEW.id;
+        UPDATE conversation_stats
+        SET version = (SELECT version FROM message_stats WHERE id = 1),
+            changed_at = (SELECT changed_at FROM message_stats WHERE id = 1)
+        WHERE conversation_id = NEW.conversation_id;
+    END;
+    """,
+    # 10: idempotency keys (see idempotency.py). Rows are only ever added
+    # with a new rowid, so rowid order is age order and the size cap is a
+    # rowid range delete.
+    """
+    CREATE TABLE idempotency_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX idempotency_keys_created_at ON idempotency_keys (created_at);
+    """,
+]
+
+
+def split_statements(script):
+    # executescript() would commit the migration transaction, so statements
+    # run one by one. complete_statement keeps trigger bodies together.
+    statements, buf = [], ""
+    for part in script.split(";"):
+        buf += part + ";"
+        if sqlite3.complete_statement(buf):
+            if buf.strip(" \n\t;"):
+                statements.append(buf.strip())
+            buf = ""
+    return statements
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Bring the database schema up to date.
+
+    Safe to call from several processes at once: the version is re-read
+    under the write lock, so each migration runs exactly once.
+    """
+    target = len(migrations)
+    if schema_version(conn) >= target:
+        return
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = schema_version(conn)
+        for version in range(current + 1, target + 1):
+            for statement in split_statements(migrations[version - 1]):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            logging.info(f"Applied database migration {version}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def acquire_lease(conn, name, owner, ttl):
+    """Take or renew lease `name` for `owner` for `ttl` seconds.
+
+    Returns True if `owner` holds the lease now: it was free, expired, or
+    already held by `owner`. Commits.
+    """
+    now = time.time()
+    cur = conn.execute(
+        "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)"
+        " ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+        " WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+        (name, owner, now + ttl, now),
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+
+class GroupCommitWriter:
+    """Single writer thread that commits many small writes in one transaction.
+
+    Callers hand over a function that performs their statements on the
+    writer's connection. Everything that queued up while the previous batch
+    was committing (up to `max_batch` items, optionally waiting `max_delay`
+    seconds for more) runs inside one transaction, each item in its own
+    savepoint so one failure doesn't sink the batch, and is committed with a
+    single fsync. `run()` blocks until the caller's work is committed
+    and returns what the function returned, e.g. a lastrowid.
+    `on_connect(conn)`, if given, sets up the writer's own connection like
+    the pool's (see ConnectionPool.on_connect). `on_commit(results)`, if
+    given, is called on the writer thread after each commit with the
+    results of the batch's successful items, in the order they ran, before
+    any caller is woken.
+    """
+
+    def __init__(self, path, max_batch=256, max_delay=0.0, pragmas=PRAGMAS, on_connect=None, on_commit=None):
+        self.path = path
+        self.pragmas = pragmas
+        self.on_connect = on_connect
+        self.on_commit = on_commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="group-commit-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def run(self, fn):
+        self.start()
+        future = Future()
+        self._queue.put((fn, future))
+        return future.result()
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        conn = connect(self.path, self.pragmas)
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                conn.execute("SAVEPOINT item")
+                try:
+                    result = fn(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO item")
+                    conn.execute("RELEASE item")
+                    results.append((future, None, e))
+                else:
+                    conn.execute("RELEASE item")
+                    results.append((future, result, None))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        if self.on_commit is not None:
+            try:
+                self.on_commit([result for _, result, error in results if error is None])
+            except Exception:
+                logging.exception("Group commit on_commit hook failed")
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+import time
+
+import blobs
+
+
+class OrphanSweeper:
+    """Background garbage collector for the upload folder.
+
+    Each run walks the folder and removes files that no message references
+    (per the `blobs` table, which mirrors `messages.audio_filename`) and
+    that are older than `grace` seconds: audio whose insert failed, leftover
+    temp files from interrupted requests, and so on. It also counts
+    referenced files that have gone missing from disk. `.partial/`, which
+    holds unfinished resumable uploads, is left to session expiry. Speech
+    pieces listed in `audio_segments` of messages still being synthesized
+    are kept too: they aren't in `blobs`, but clients may be playing them.
+
+    The sweep is paced to at most `max_ops` file operations per second and
+    runs in a low-priority thread, so it stays out of the way of requests.
+    Files are only removed inside a write transaction after re-checking
+    their reference count, the same way blobs.release() does.
+    """
+
+    def __init__(self, get_conn, get_directory, interval=3600.0, grace=3600.0, max_ops=200, batch=50,
+                 should_run=None):
+        self.get_conn = get_conn
+        self.get_directory = get_directory
+        self.interval = interval
+        self.grace = grace
+        self.max_ops = max_ops
+        self.batch = batch
+        # Checked before each scheduled run; with several worker processes
+        # sharing one upload folder, only the one holding a lease sweeps.
+        self.should_run = should_run
+        self._stop = threading.Event()
+        self._thread = None
+        self._next_op = 0.0
+        self.runs = 0
+        self.removed = 0
+        self.reclaimed_bytes = 0
+        self.last_run = None
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="orphan-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "removed": self.removed,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "last_run": self.last_run,
+        }
+
+    def run_once(self):
+        """Sweep once and return a report of what was found and reclaimed."""
+        started = time.monotonic()
+        directory = self.get_directory()
+        conn = self.get_conn()
+        report = {"scanned": 0, "removed": 0, "reclaimed_bytes": 0, "missing": 0}
+        suspects = []
+        segments = self._segments(conn)
+        for path, name in self._files(directory):
+            report["scanned"] += 1
+            if name in segments or self._referenced(conn, name):
+                continue
+            suspects.append((path, name))
+            if len(suspects) >= self.batch:
+                self._reclaim(conn, suspects, report)
+                suspects = []
+        if suspects:
+            self._reclaim(conn, suspects, report)
+
+        for row in conn.execute("SELECT name FROM blobs WHERE refcount > 0").fetchall():
+            self._pace()
+            if blobs.locate(directory, row["name"]) is None:
+                report["missing"] += 1
+        if report["missing"]:
+            logging.warning(f"{report['missing']} referenced audio file(s) are missing from {directory}")
+
+        report["duration"] = round(time.monotonic() - started, 3)
+        self.runs += 1
+        self.removed += report["removed"]
+        self.reclaimed_bytes += report["reclaimed_bytes"]
+        self.last_run = report
+        logging.info(f"Orphan sweep removed {report['removed']} file(s), "
+                     f"reclaimed {report['reclaimed_bytes']} bytes")
+        return report
+
+    def _loop(self):
+        try:
+            # Linux lets a single thread lower its own priority; CPU and
+            # (under CFQ/BFQ) I/O scheduling both follow it.
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+        while not self._stop.wait(self.interval):
+            try:
+                if self.should_run is None or self.should_run():
+                    self.run_once()
+            except Exception:
+                logging.exception("Orphan sweep failed")
+
+    def _pace(self):
+        now = time.monotonic()
+        self._next_op = max(self._next_op + 1.0 / self.max_ops, now)
+        if self._next_op > now:
+            time.sleep(self._next_op - now)
+
+    def _files(self, directory):
+        # Yields (path, name) for regular files older than the grace period.
+        cutoff = time.time() - self.grace
+        stack = [directory]
+        while stack and not self._stop.is_set():
+            top = stack.pop()
+            try:
+                entries = list(os.scandir(top))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                self._pace()
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".partial":
+                        stack.append(entry.path)
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                        yield entry.path, entry.name
+                except FileNotFoundError:
+                    continue
+
+    def _segments(self, conn):
+        # Pieces of replies whose speech is still being synthesized.
+        rows = conn.execute(
+            "SELECT DISTINCT s.value FROM messages, json_each(messages.audio_segments) AS s"
+            " WHERE messages.tts_status = 'partial'"
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def _referenced(self, conn, name):
+        row = conn.execute("SELECT 1 FROM blobs WHERE name = ? AND refcount > 0", (name,)).fetchone()
+        return row is not None
+
+    def _reclaim(self, conn, suspects, report):
+        # Re-check under the write lock: an upload may have claimed the blob
+        # since it was looked at.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            segments = self._segments(conn)
+            for path, name in suspects:
+                if name in segments or self._referenced(conn, name):
+                    continue
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                conn.execute("DELETE FROM blobs WHERE name = ?", (name,))
+                report["removed"] += 1
+                report["reclaimed_bytes"] += size
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
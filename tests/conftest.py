@@ -0,0 +1,26 @@
+import pytest
+
+import app as chat
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    # Builds an app on a fresh database and upload folder under tmp_path.
+    apps = []
+
+    def make(**config):
+        app = chat.create_app({
+            "DATABASE": str(tmp_path / "chat.db"),
+            "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+            "TTS_CACHE_DIR": str(tmp_path / "tts_cache"),
+            **config,
+        })
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        writer = app.extensions["chat"].writer
+        if writer is not None:
+            writer.stop()
+    chat.storage.pool.close()
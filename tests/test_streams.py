@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+import app as chat
+
+WRITERS = 8
+INSERTS = 100
+
+
+@pytest.mark.parametrize("group_commit", [False, True])
+def test_concurrent_inserts_all_reach_the_stream(make_app, monkeypatch, group_commit):
+    app = make_app(GROUP_COMMIT=group_commit)
+    monkeypatch.setattr(chat, "SSE_HEARTBEAT", 0.5)
+    resp = app.test_client().get("/api/messages/stream?conversation_id=c", buffered=False)
+
+    def insert():
+        with app.app_context():
+            for i in range(INSERTS):
+                chat.insert_message("user", str(i), None, conversation_id="c")
+
+    threads = [threading.Thread(target=insert) for _ in range(WRITERS)]
+    for t in threads:
+        t.start()
+    ids = []
+    try:
+        for chunk in resp.response:
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if chunk.startswith("event: insert"):
+                ids.append(int(chunk.split("\n")[1].removeprefix("id: ")))
+            elif chunk.startswith(": keep-alive") and not any(t.is_alive() for t in threads):
+                break
+            if len(ids) == WRITERS * INSERTS:
+                break
+    finally:
+        resp.close()
+        for t in threads:
+            t.join()
+
+    with app.app_context():
+        stored = [r["id"] for r in chat.get_db().execute("SELECT id FROM messages ORDER BY id")]
+    assert ids == stored
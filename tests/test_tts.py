@@ -0,0 +1,31 @@
+import os
+
+from benchmarks.stubs import FakeTTSClient
+from tts import TTSService
+
+TEXT = "First sentence here. Second sentence here. Third sentence here."
+
+
+def test_retry_after_eviction_passes_each_piece_on_once(tmp_path):
+    service = TTSService(
+        FakeTTSClient(0, 100), str(tmp_path / "cache"), 1024 * 1024,
+        "voice", "model", "mp3_44100_128", segment_chars=25,
+    )
+    synthesize = service.synthesize
+    evicted = []
+
+    def evict_first(text, on_segment=None):
+        # The full file is gone before synthesize_to can link it, once.
+        path = synthesize(text, on_segment)
+        if text == TEXT and not evicted:
+            evicted.append(path)
+            os.remove(path)
+        return path
+
+    service.synthesize = evict_first
+    pieces = []
+    name = service.synthesize_to(TEXT, str(tmp_path), lambda index, path: pieces.append(index))
+
+    assert evicted
+    assert pieces == [0, 1, 2]
+    assert os.path.getsize(tmp_path / name) == 300
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+DATA = b"0123456789"
+
+
+@pytest.fixture
+def client(make_app):
+    app = make_app()
+    with open(os.path.join(app.config["UPLOAD_FOLDER"], "a.mp3"), "wb") as f:
+        f.write(DATA)
+    return app.test_client()
+
+
+@pytest.mark.parametrize("header, status, body", [
+    ("bytes=2-4", 206, DATA[2:5]),
+    ("bytes=-3", 206, DATA[-3:]),
+    ("bytes=20-30", 416, b""),
+    # Several ranges aren't served as multipart/byteranges: the whole file
+    # is sent instead, unless none of them overlaps it.
+    ("bytes=0-1,5-6", 200, DATA),
+    ("bytes=5-6,20-30", 200, DATA),
+    ("bytes=20-30,40-50", 416, b""),
+])
+def test_ranges(client, header, status, body):
+    resp = client.get("/uploads/a.mp3", headers={"Range": header})
+    assert resp.status_code == status
+    assert resp.get_data() == body
+    if status == 416:
+        assert resp.headers["Content-Range"] == f"bytes */{len(DATA)}"
@@ -0,0 +1,317 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+
+def normalize_text(text):
+    # Whitespace and Unicode composition differences don't change the spoken
+    # result, so they shouldn't produce separate cache entries.
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# Sentence ends: terminal punctuation (and closing quotes/brackets) followed
+# by whitespace.
+SENTENCE_END = re.compile(r"(?<=[.!?…。！？])[\"'”’)\]]*\s+")
+
+
+def split_segments(text, max_chars):
+    """Split `text` into sentence-sized pieces for separate synthesis.
+
+    The first piece is the first sentence alone, so it is ready soonest.
+    After that, consecutive sentences are packed into pieces of up to
+    `max_chars` so short sentences don't each cost an upstream call. A
+    single sentence longer than that becomes a piece of its own. Returns
+    one piece for short texts or when `max_chars` is 0.
+    """
+    text = normalize_text(text)
+    if not max_chars or len(text) <= max_chars:
+        return [text]
+    sentences = [s for s in SENTENCE_END.split(text) if s]
+    segments = sentences[:1]
+    for sentence in sentences[1:]:
+        if len(segments) > 1 and len(segments[-1]) + 1 + len(sentence) <= max_chars:
+            segments[-1] += " " + sentence
+        else:
+            segments.append(sentence)
+    return segments
+
+
+def extension_for(output_format):
+    # ElevenLabs formats look like "mp3_44100_128", "pcm_16000", "ulaw_8000".
+    return "." + output_format.split("_", 1)[0]
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.path = None
+        self.error = None
+
+
+class TTSCache:
+    """Size-capped, least-recently-used cache of synthesized audio on disk.
+
+    Entries are files named by their content key. Recency is persisted in
+    the file mtimes, so the LRU order survives restarts.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._bytes += size
+        self._evict()
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed behind our back; forget it and treat as a miss.
+            with self._lock:
+                self._bytes -= self._entries.pop(name, 0)
+            return None
+        return path
+
+    def put(self, name, tmp_path):
+        path = os.path.join(self.directory, name)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._bytes += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+        return path
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the cap.
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class TTSService:
+    """Text-to-speech through ElevenLabs with a content-addressed cache.
+
+    Requests are keyed by a hash of (normalized text, voice, model, output
+    format). Concurrent requests for the same key share one upstream call.
+
+    Texts longer than `segment_chars` are synthesized sentence by sentence:
+    the pieces go upstream concurrently through one pool of `max_parallel`
+    threads shared by all requests, are cached like any other text, and are
+    handed to the caller in order as each becomes ready. The full audio is
+    the pieces joined, which MP3 and the raw PCM/u-law formats allow.
+
+    With a `budget` (limits.Budget), every upstream call holds one of its
+    slots, so the cap counts pieces in flight across all processes. A call
+    waits up to `slot_wait` seconds for a free slot (pieces of one reply
+    may be queued behind each other), then raises limits.Overloaded. Cache
+    hits need no slot.
+    """
+
+    def __init__(self, client, cache_dir, max_cache_bytes, voice_id, model_id, output_format,
+                 segment_chars=300, max_parallel=4, budget=None, slot_wait=5.0):
+        self.client = client
+        self.voice_id = voice_id
+        self.model_id = model_id
+        self.output_format = output_format
+        self.cache = TTSCache(cache_dir, max_cache_bytes)
+        self.segment_chars = segment_chars
+        self.budget = budget
+        self.slot_wait = slot_wait
+        self._pool = ThreadPoolExecutor(max_parallel, thread_name_prefix="tts")
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_errors = 0
+        self.segmented = 0
+
+    def cache_key(self, text):
+        parts = (normalize_text(text), self.voice_id, self.model_id, self.output_format)
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def synthesize(self, text, on_segment=None):
+        """Return the path of a cached audio file for `text`.
+
+        When `text` is split into pieces and has to be synthesized, each
+        piece's cached path is passed to `on_segment(index, path)` in order
+        as soon as it and the ones before it are ready. Callers waiting on
+        someone else's request for the same text only get the full file.
+        """
+        name = self.cache_key(text) + extension_for(self.output_format)
+        path = self.cache.get(name)
+        if path is not None:
+            with self._lock:
+                self.hits += 1
+            return path
+
+        with self._lock:
+            flight = self._inflight.get(name)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[name] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.path
+
+        try:
+            segments = split_segments(text, self.segment_chars)
+            if len(segments) > 1:
+                flight.path = self._fetch_segments(segments, name, on_segment)
+            else:
+                flight.path = self._fetch(text, name)
+            return flight.path
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.upstream_errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[name]
+            flight.done.set()
+
+    def _fetch(self, text, name):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache.directory, prefix=".tmp-")
+        try:
+            # The slot covers the whole download: streamed audio keeps the
+            # upstream call open until the last chunk.
+            with os.fdopen(fd, "wb") as f, (self.budget.slot(self.slot_wait) if self.budget else nullcontext()):
+                audio = self.client.text_to_speech.convert(
+                    text=normalize_text(text),
+                    voice_id=self.voice_id,
+                    model_id=self.model_id,
+                    output_format=self.output_format,
+                )
+                if isinstance(audio, bytes):
+                    f.write(audio)
+                else:
+                    for chunk in audio:
+                        f.write(chunk)
+            return self.cache.put(name, tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _fetch_segments(self, segments, name, on_segment):
+        with self._lock:
+            self.segmented += 1
+        futures = [self._pool.submit(self.synthesize, segment) for segment in segments]
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache.directory, prefix=".tmp-")
+        try:
+            # Join the pieces into the full file as they arrive, in order.
+            with os.fdopen(fd, "wb") as out:
+                for i, (segment, future) in enumerate(zip(segments, futures)):
+                    path = future.result()
+                    try:
+                        f = open(path, "rb")
+                    except FileNotFoundError:
+                        # Evicted in the meantime; fetch this piece again.
+                        path = self.synthesize(segment)
+                        f = open(path, "rb")
+                    with f:
+                        if on_segment is not None:
+                            on_segment(i, path)
+                        shutil.copyfileobj(f, out)
+            return self.cache.put(name, tmp_path)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def synthesize_to(self, text, directory, on_segment=None):
+        """Synthesize `text` into a new uniquely named file in `directory`.
+
+        Returns the new file name. The file is a hard link to the cache entry
+        where possible, so a cache hit costs no audio I/O.
+        """
+        filename = f"{uuid.uuid4().hex}{extension_for(self.output_format)}"
+        dest = os.path.join(directory, filename)
+        delivered = set()
+
+        def deliver(index, path):
+            # A retry goes through the pieces again; pass each on only once.
+            if index not in delivered:
+                delivered.add(index)
+                on_segment(index, path)
+
+        for attempt in range(2):
+            src = self.synthesize(text, deliver if on_segment is not None else None)
+            try:
+                os.link(src, dest)
+            except FileNotFoundError:
+                # Evicted between lookup and link; synthesize again once.
+                if attempt:
+                    raise
+                logging.info("TTS cache entry evicted before use, retrying")
+                continue
+            except OSError:
+                shutil.copyfile(src, dest)
+            return filename
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "upstream_errors": self.upstream_errors,
+                "segmented": self.segmented,
+                "evictions": self.cache.evictions,
+                "entries": len(self.cache),
+                "bytes": self.cache.size,
+                "max_bytes": self.cache.max_bytes,
+            }
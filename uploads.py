@@ -0,0 +1,75 @@
+import os
+import re
+import tempfile
+
+from flask import Request
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Raised when an incoming body exceeds the configured size cap."""
+
+
+def upload_ext(name, content_type=None, default=".webm"):
+    # Keep the client's extension when it looks like one; stored names are
+    # always <random hex><ext>, so this is cosmetic but must stay path-safe.
+    ext = os.path.splitext(name or "")[1].lower()
+    if re.fullmatch(r"\.[a-z0-9]{1,10}", ext):
+        return ext
+    if content_type:
+        subtype = content_type.split(";", 1)[0].split("/")[-1].strip().lower()
+        if re.fullmatch(r"[a-z0-9]{1,10}", subtype):
+            return "." + ("mp3" if subtype == "mpeg" else subtype)
+    return default
+
+
+def copy_stream(stream, f, limit, already=0, hasher=None):
+    """Copy `stream` into the open file `f` in fixed-size chunks.
+
+    Never holds more than one chunk in memory. Raises UploadTooLarge as soon
+    as `already` + bytes copied would pass `limit`. Chunks are also fed to
+    `hasher` when given. Returns bytes copied.
+    """
+    copied = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if already + copied > limit:
+            raise UploadTooLarge(f"upload exceeds {limit} bytes")
+        f.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+
+
+class UploadRequest(Request):
+    """Request class that spools multipart file fields into the upload folder.
+
+    werkzeug normally buffers file fields in memory or the system temp dir
+    and `FileStorage.save` then copies them again. Spooling next to their
+    final location lets the upload handler hard-link the spooled file into
+    place instead, so each byte is written once.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        from flask import current_app
+
+        return tempfile.NamedTemporaryFile(dir=current_app.config["UPLOAD_FOLDER"], prefix=".spool-")
+
+
+def save_file_storage(file_storage, dest):
+    # Link the spooled temp file into place (it is removed when the request
+    # closes its stream); fall back to copying for other stream types.
+    stream = file_storage.stream
+    name = getattr(stream, "name", None)
+    if isinstance(name, str) and os.path.dirname(name) == os.path.dirname(dest):
+        stream.flush()
+        try:
+            os.link(name, dest)
+            return
+        except OSError:
+            pass
+    file_storage.save(dest)
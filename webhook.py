@@ -0,0 +1,158 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the webhook while the circuit is open."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"webhook circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After `failure_threshold` failures in a row the circuit opens and calls
+    fail fast for `reset_timeout` seconds. Then a single trial call is let
+    through (half-open): success closes the circuit, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._probing or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._probing:
+                raise CircuitOpen(max(remaining, 1.0))
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logging.warning(f"Webhook circuit opened after {self._failures} consecutive failure(s)")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class WebhookClient:
+    """Shared client for the outbound webhook.
+
+    Requests go through one `requests.Session`, so connections (and TLS
+    sessions) are kept alive and reused, up to `pool_size` at once; further
+    callers wait for a free connection. Only failures where the request
+    cannot have reached the webhook (connection refused, connect timeout)
+    or that it explicitly refused with 503 are retried here, after a
+    jittered backoff; anything else is left to the caller, because posting
+    an upload twice would produce two replies. Connection errors, timeouts
+    and 5xx responses count against a circuit breaker, which makes `post`
+    raise CircuitOpen straight away while the webhook is down.
+    """
+
+    def __init__(self, url, pool_size=10, connect_timeout=3.05, read_timeout=30.0, retries=2,
+                 backoff=0.5, failure_threshold=5, reset_timeout=30.0):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.short_circuited = 0
+
+    def post(self, files=None, data=None):
+        try:
+            self.breaker.before_call()
+        except CircuitOpen:
+            self._count("short_circuited")
+            raise
+        # The multipart body is encoded once and resent as-is on retries.
+        prepared = self.session.prepare_request(requests.Request("POST", self.url, files=files, data=data))
+        attempt = 0
+        while True:
+            self._count("requests")
+            try:
+                resp = self.session.send(prepared, timeout=self.timeout)
+            except requests.RequestException as e:
+                if self._retryable(e) and attempt < self.retries:
+                    attempt = self._sleep(attempt, e)
+                    continue
+                self._failed()
+                raise
+            if resp.status_code == 503 and attempt < self.retries:
+                attempt = self._sleep(attempt, f"HTTP {resp.status_code}")
+                continue
+            if resp.status_code >= 500:
+                self._failed()
+            else:
+                self.breaker.record_success()
+            return resp
+
+    def stats(self):
+        return {
+            "circuit": self.breaker.state,
+            "requests": self.requests,
+            "retried": self.retried,
+            "failures": self.failures,
+            "short_circuited": self.short_circuited,
+        }
+
+    def _retryable(self, error):
+        # A read timeout or a reset mid-response means the webhook may
+        # already have acted on the body.
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def _sleep(self, attempt, reason):
+        delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+        logging.warning(f"Webhook attempt {attempt + 1} failed ({reason}), retrying in {delay:.2f}s")
+        self._count("retried")
+        time.sleep(delay)
+        return attempt + 1
+
+    def _failed(self):
+        self._count("failures")
+        self.breaker.record_failure()
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
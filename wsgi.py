@@ -0,0 +1,16 @@
+# Production entry point for prefork servers, e.g. `gunicorn` (which reads
+# gunicorn.conf.py) or `gunicorn -w 4 --threads 16 wsgi:application`.
+#
+# Every worker process imports this module itself, creates or upgrades the
+# schema (safe when several start at once) and runs its own job workers,
+# orphan sweeper and event relay. What they share lives in SQLite: the job
+# queue (with leases, so a dead worker's jobs are picked up by the others),
+# the sweeper lease, and the events table that carries stream notifications
+# between workers. Don't preload the app: background threads started before
+# the fork would not exist in the workers.
+import os
+
+from app import create_app, start_background
+
+application = create_app({"EVENT_LOG": os.getenv("EVENT_LOG", "1") == "1"})
+start_background(application)